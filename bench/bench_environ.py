@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+#
+# Measures the memory allocated to build the environ for a request
+# when a handler reads only a few keys, against the cost of every
+# entry being computed as happened before the environ became lazy.
+#
+#   python bench/bench_environ.py [-n NUMBER]
+
+import optparse as op
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.http as http
+import wsgiref2.wsgi as wsgi
+
+from wsgiref2.testing import FakeSocket
+from wsgiref2.util import b
+
+REQUEST = b("\r\n").join([
+    b("GET /api/v1/items?id=3&fields=name,price HTTP/1.1"),
+    b("Host: example.com:8080"),
+    b("User-Agent: bench/1.0"),
+    b("Accept: application/json"),
+    b("Accept-Encoding: gzip, deflate"),
+    b("Cookie: session=0123456789abcdef"),
+    b("Connection: keep-alive"),
+    b(""), b("")
+])
+
+def parse():
+    unreader = http.Unreader(FakeSocket(REQUEST))
+    httpreq = http.Request(unreader)
+    unreader.close()
+    return httpreq
+
+def few_keys(httpreq):
+    environ = wsgi.Request(("127.0.0.1", 8000), ("127.0.0.1", 5000),
+                            None, httpreq).environ
+    environ["http.method"], environ["http.uri.path"]
+    environ["http.headers"].get(b("accept"))
+    return environ
+
+def every_key(httpreq):
+    environ = wsgi.Request(("127.0.0.1", 8000), ("127.0.0.1", 5000),
+                            None, httpreq).environ
+    environ.load()
+    environ["http.method"], environ["http.uri.path"]
+    environ["http.headers"].get(b("accept"))
+    return environ
+
+CASES = [
+    ("every key", every_key),
+    ("three keys", few_keys)
+]
+
+def allocated(func, number):
+    # Keep every environ alive so all of their memory is counted.
+    httpreqs = [parse() for i in range(number)]
+    keep = []
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for httpreq in httpreqs:
+            keep.append(func(httpreq))
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    size = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    return float(size) / number, float(blocks) / number
+
+def main():
+    parser = op.OptionParser(usage="usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--number", dest="number", type="int",
+        default=10000, help="Requests per case. [%default]")
+    opts, args = parser.parse_args()
+
+    httpreq = parse()
+    for name, func in CASES:
+        size, blocks = allocated(func, opts.number)
+        timer = timeit.Timer(lambda: func(httpreq))
+        per_call = min(timer.repeat(3, opts.number)) / opts.number * 1e6
+        print("%-12s %8.1f bytes/req  %6.1f blocks/req  %7.3f us/req" % (
+                name, size, blocks, per_call))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+#
+# Compares the uri.parse fast path and cache against the regular
+# expression parser it replaced for common request targets.
+#
+#   python bench/bench_uri.py [-n NUMBER]
+
+import optparse as op
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.uri as uri
+
+from wsgiref2.util import b
+
+TARGETS = [
+    b("/"),
+    b("/api/v1/items?id=3"),
+    b("/static/css/site.min.css"),
+    b("/search?q=wsgi+server&page=2&sort=desc#results"),
+    b("/users/1234/orders/5678;v=2?expand=lines%2Citems"),
+    b("http://example.com:8080/proxy/path?x=1")
+]
+
+def uncached(value):
+    ret = uri.parse_path(value)
+    if ret is None:
+        ret = uri.parse_regex(value)
+    return ret
+
+CASES = [
+    ("regex", uri.parse_regex),
+    ("fast path", uncached),
+    ("fast path + cache", uri.parse)
+]
+
+def main():
+    parser = op.OptionParser(usage="usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--number", dest="number", type="int",
+        default=20000, help="Iterations per target. [%default]")
+    opts, args = parser.parse_args()
+
+    baseline = None
+    for name, func in CASES:
+        uri.cache.clear()
+        total = 0.0
+        for target in TARGETS:
+            timer = timeit.Timer(lambda: func(target))
+            total += min(timer.repeat(3, opts.number))
+        per_call = total / (opts.number * len(TARGETS)) * 1e6
+        if baseline is None:
+            baseline = per_call
+        print("%-20s %8.3f us/parse  %6.2fx" % (name, per_call,
+                baseline / per_call))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.aio as aio
+
+from wsgiref2.util import b
+
+
+def start(app):
+    srv = type("Server", (aio.AsyncHTTPServer,), {"app": app})(
+                ("127.0.0.1", 0), threads=2)
+    thread = threading.Thread(target=srv.run)
+    thread.daemon = True
+    thread.start()
+    return srv.sock.getsockname()
+
+
+def exchange(address, *pieces):
+    """\
+    Send pieces with a short pause between them, so bodies
+    arrive after the head, and return everything received
+    until the server closes the connection.
+    """
+    sock = socket.create_connection(address, 2)
+    try:
+        for piece in pieces:
+            sock.sendall(piece)
+            time.sleep(0.05)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b("").join(chunks)
+    finally:
+        sock.close()
+
+
+def responses(out):
+    """\
+    Split the Content-Length framed responses in out into their
+    bodies.
+    """
+    bodies = []
+    while out:
+        head, out = out.split(b("\r\n\r\n"), 1)
+        size = 0
+        for line in head.split(b("\r\n"))[1:]:
+            name, value = line.split(b(":"), 1)
+            if name.lower() == b("content-length"):
+                size = int(value)
+        bodies.append(out[:size])
+        out = out[size:]
+    return bodies
+
+
+def reply(body):
+    return 200, [(b("Content-Length"), b(str(len(body))))], [body]
+
+
+class AsyncAppTest(unittest.TestCase):
+    def test_read(self):
+        async def app(self, environ):
+            body = environ["http.body"]
+            first = await body.read(5)
+            rest = await body.read()
+            return reply(first + b("|") + rest)
+        address = start(app)
+        out = exchange(address,
+                b("POST / HTTP/1.1\r\nContent-Length: 11\r\n"
+                    "Connection: close\r\n\r\nhel"), b("lo world"))
+        self.assertEqual(responses(out), [b("hello| world")])
+
+    def test_lines_chunked(self):
+        async def app(self, environ):
+            body = environ["http.body"]
+            first = await body.readline()
+            lines = [line async for line in body]
+            return reply(first + b("|") + b("|").join(lines))
+        address = start(app)
+        out = exchange(address,
+                b("POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n"
+                    "Connection: close\r\n\r\n4\r\na\nb\n\r\n"),
+                b("3\r\nc\nd\r\n0\r\n\r\n"))
+        self.assertEqual(responses(out), [b("a\n|b\n|c\n|d")])
+
+    def test_unread_body(self):
+        async def app(self, environ):
+            return reply(environ["http.uri.path"])
+        address = start(app)
+        out = exchange(address,
+                b("POST /a HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+                    "GET /b HTTP/1.1\r\nConnection: close\r\n\r\n"))
+        self.assertEqual(responses(out), [b("/a"), b("/b")])
+
+    def test_async_body(self):
+        class Body(object):
+            def __init__(self):
+                self.closed = False
+            def __aiter__(self):
+                return self.produce()
+            async def produce(self):
+                for data in (b("one "), b("two")):
+                    await asyncio.sleep(0.01)
+                    yield data
+            async def aclose(self):
+                self.closed = True
+        bodies = []
+        async def app(self, environ):
+            bodies.append(Body())
+            return 200, [], bodies[-1]
+        address = start(app)
+        out = exchange(address,
+                b("GET / HTTP/1.1\r\nConnection: close\r\n\r\n"))
+        self.assertTrue(b("Transfer-Encoding: chunked") in out)
+        data, chunks = out.split(b("\r\n\r\n"), 1)[1], []
+        while True:
+            size, data = data.split(b("\r\n"), 1)
+            if not int(size, 16):
+                break
+            chunks.append(data[:int(size, 16)])
+            data = data[int(size, 16) + 2:]
+        self.assertEqual(b("").join(chunks), b("one two"))
+        self.assertTrue(bodies[0].closed)
+
+    def test_sync_app(self):
+        def app(self, environ):
+            return reply(environ["http.body"].read())
+        address = start(app)
+        out = exchange(address,
+                b("POST / HTTP/1.1\r\nContent-Length: 3\r\n\r\none"
+                    "POST / HTTP/1.1\r\nContent-Length: 3\r\n"
+                    "Connection: close\r\n\r\ntwo"))
+        self.assertEqual(responses(out), [b("one"), b("two")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.cache as cache
+import wsgiref2.http as http
+import wsgiref2.wsgi as wsgi
+
+from wsgiref2.util import b
+
+
+def environ(uri="/", method="GET", *headers):
+    parsed = http.Headers()
+    for header in headers:
+        name, value = header.split(":", 1)
+        parsed.add(b(name), b(value.strip()))
+    return {
+        "http.method": b(method),
+        "http.uri.raw": b(uri),
+        "http.headers": parsed,
+        "wsgi.flush": wsgi.FLUSH
+    }
+
+
+class App(object):
+    """\
+    Answers with the number of calls so far and the headers
+    given, which tells cached responses from fresh ones.
+    """
+    def __init__(self, headers, stream=False):
+        self.headers = headers
+        self.stream = stream
+        self.calls = 0
+
+    def __call__(self, environ):
+        self.calls += 1
+        lang = environ["http.headers"].last(b("accept-language"), b(""))
+        body = [b("call %d " % self.calls), lang]
+        if self.stream:
+            body = iter(body)
+        return 200, [(b(n), b(v)) for (n, v) in self.headers], body
+
+
+def call(app, env):
+    status, headers, body = app(env)
+    data = b("").join(body)
+    if hasattr(body, "close"):
+        body.close()
+    return status, headers, data
+
+
+class CacheTest(unittest.TestCase):
+    def test_replay(self):
+        app = App([("Cache-Control", "max-age=60")])
+        middleware = cache.Cache(app)
+        first = call(middleware, environ())
+        second = call(middleware, environ())
+        self.assertEqual(app.calls, 1)
+        self.assertEqual(second[2], first[2])
+        self.assertTrue((b("Age"), b("0")) in second[1])
+
+    def test_streamed(self):
+        app = App([("Cache-Control", "max-age=60")], stream=True)
+        middleware = cache.Cache(app)
+        first = call(middleware, environ())
+        self.assertEqual(call(middleware, environ())[2], first[2])
+        self.assertEqual(app.calls, 1)
+
+    def test_not_stored(self):
+        for headers in ([], [("Cache-Control", "no-store, max-age=60")],
+                        [("Cache-Control", "max-age=60"),
+                            ("Set-Cookie", "a=b")],
+                        [("Cache-Control", "max-age=60"), ("Vary", "*")]):
+            app = App(headers)
+            middleware = cache.Cache(app)
+            call(middleware, environ())
+            call(middleware, environ())
+            self.assertEqual(app.calls, 2, headers)
+
+    def test_bypass(self):
+        app = App([("Cache-Control", "max-age=60")])
+        middleware = cache.Cache(app)
+        call(middleware, environ())
+        for header in ("Authorization: Basic eDp5", "Cache-Control: no-cache",
+                        "Pragma: no-cache"):
+            call(middleware, environ("/", "GET", header))
+        call(middleware, environ("/", "POST"))
+        self.assertEqual(app.calls, 5)
+
+    def test_vary(self):
+        app = App([("Cache-Control", "max-age=60"),
+                    ("Vary", "Accept-Language")])
+        middleware = cache.Cache(app)
+        en = call(middleware, environ("/", "GET", "Accept-Language: en"))
+        fr = call(middleware, environ("/", "GET", "Accept-Language: fr"))
+        self.assertEqual(app.calls, 2)
+        self.assertEqual(en[2], b("call 1 en"))
+        self.assertEqual(fr[2], b("call 2 fr"))
+        again = call(middleware, environ("/", "GET", "Accept-Language: en"))
+        self.assertEqual(again[2], en[2])
+        self.assertEqual(app.calls, 2)
+
+    def test_not_modified(self):
+        app = App([("Cache-Control", "max-age=60"), ("ETag", '"v1"'),
+                    ("Content-Type", "text/plain")])
+        middleware = cache.Cache(app)
+        call(middleware, environ())
+        status, headers, data = call(middleware,
+                            environ("/", "GET", 'If-None-Match: "v0", W/"v1"'))
+        self.assertEqual(status, 304)
+        self.assertEqual(data, b(""))
+        names = [name.lower() for name, value in headers]
+        self.assertTrue(b("etag") in names)
+        self.assertFalse(b("content-type") in names)
+        status = call(middleware,
+                        environ("/", "GET", 'If-None-Match: "v2"'))[0]
+        self.assertEqual(status, 200)
+        self.assertEqual(app.calls, 1)
+
+    def test_expired(self):
+        app = App([("Cache-Control", "max-age=60")])
+        middleware = cache.Cache(app)
+        call(middleware, environ())
+        for value, weight in middleware.entries.data.values():
+            value.expires = 0
+        call(middleware, environ())
+        self.assertEqual(app.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
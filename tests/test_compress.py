@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.compress as compress
+import wsgiref2.http as http
+import wsgiref2.wsgi as wsgi
+
+from wsgiref2.util import b
+
+
+def environ():
+    headers = http.Headers()
+    headers.add(b("Accept-Encoding"), b("gzip"))
+    return {
+        "http.method": b("GET"),
+        "http.headers": headers,
+        "wsgi.flush": wsgi.FLUSH
+    }
+
+
+class FlushTest(unittest.TestCase):
+    def call(self, first):
+        produced = []
+        def events():
+            for data in first:
+                produced.append(data)
+                yield data
+            produced.append(b("later"))
+            yield b("data: ") + b("y") * 4096 + b("\n\n")
+        def app(environ):
+            return 200, [(b("Content-Type"), b("text/event-stream"))], events()
+        status, headers, body = compress.Compress(app)(environ())
+        self.assertEqual(produced, list(first))
+        return headers, list(body)
+
+    def test_small_event(self):
+        headers, body = self.call([b("data: x\n\n"), wsgi.FLUSH])
+        self.assertEqual(body[:2], [b("data: x\n\n"), wsgi.FLUSH])
+        self.assertFalse((b("Content-Encoding"), b("gzip")) in headers)
+
+    def test_compressible_event(self):
+        event = b("data: ") + b("x") * 512 + b("\n\n")
+        headers, body = self.call([event, wsgi.FLUSH])
+        self.assertTrue((b("Content-Encoding"), b("gzip")) in headers)
+        self.assertTrue(body[1] is wsgi.FLUSH)
+        data = b("").join([d for d in body if d is not wsgi.FLUSH])
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertTrue(inflater.decompress(body[0]).startswith(event))
+        self.assertTrue(zlib.decompress(data, 16 + zlib.MAX_WBITS)
+                            .startswith(event))
+
+
+class VaryTest(unittest.TestCase):
+    def call(self, body):
+        def app(environ):
+            return 200, [(b("Content-Type"), b("text/plain"))], body
+        status, headers, body = compress.Compress(app)(environ())
+        return headers
+
+    def test_uncompressed(self):
+        noise = os.urandom(4096)
+        for body in ([b("small")], [noise], iter([b("small")]),
+                        iter([noise])):
+            headers = self.call(body)
+            self.assertFalse((b("Content-Encoding"), b("gzip")) in headers)
+            self.assertTrue((b("Vary"), b("Accept-Encoding")) in headers)
+
+    def test_compressed(self):
+        headers = self.call([b("x") * 4096])
+        self.assertTrue((b("Content-Encoding"), b("gzip")) in headers)
+        self.assertTrue((b("Vary"), b("Accept-Encoding")) in headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
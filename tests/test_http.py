@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import sys
+import tracemalloc
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.http as http
+
+from wsgiref2.testing import FakeSocket
+from wsgiref2.util import b
+
+
+def request(data, **kwargs):
+    return http.Request(http.Unreader(FakeSocket(data)), **kwargs)
+
+
+class URITest(unittest.TestCase):
+    def test_invalid_target(self):
+        for target in (b("/a<b"), b("//x{}")):
+            data = b("GET ") + target + b(" HTTP/1.1\r\n\r\n")
+            self.assertRaises(http.ParseError, request, data)
+
+    def test_lazy_parts(self):
+        req = request(b("GET http://example.com/a?b HTTP/1.1\r\n\r\n"))
+        self.assertTrue(req.parts is None)
+        self.assertEqual(req.path, b("/a"))
+        self.assertEqual(req.query, b("b"))
+        self.assertEqual(req.port, b("80"))
+
+
+class ChunkedTest(unittest.TestCase):
+    def body(self, chunks):
+        req = request(b("POST / HTTP/1.1\r\nTransfer-Encoding: chunked"
+                        "\r\n\r\n") + chunks)
+        return req.body.read()
+
+    def test_chunks(self):
+        data = self.body(b("5\r\nhello\r\nA;ext=1\r\n0123456789\r\n"
+                            "0\r\n\r\n"))
+        self.assertEqual(data, b("hello0123456789"))
+
+    def test_invalid_size(self):
+        for size in (b("0x5"), b("+5"), b("5_0"), b(" 5"), b(""), b("-5")):
+            chunks = size + b("\r\nhello\r\n0\r\n\r\n")
+            self.assertRaises(http.ParseError, self.body, chunks)
+
+
+class BodyTest(unittest.TestCase):
+    def peak(self, func):
+        tracemalloc.start()
+        try:
+            ret = func()
+            return ret, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_large_claimed_length(self):
+        data = b("POST / HTTP/1.1\r\nContent-Length: 4000000000\r\n\r\nabc")
+        for size in (None, 4000000000):
+            body = request(data).body
+            ret, peak = self.peak(lambda: body.read(size))
+            self.assertEqual(ret, b("abc"))
+            self.assertTrue(peak < 8 * 1024 * 1024, peak)
+
+    def test_read_grows(self):
+        payload = b("x") * (http.MAX_READ * 3 + 5)
+        data = b("POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n"
+                    % len(payload)) + payload
+        self.assertEqual(request(data).body.read(), payload)
+        body = request(data).body
+        self.assertEqual(body.read(len(payload) - 1), payload[:-1])
+        self.assertEqual(body.read(), b("x"))
+
+
+class SpoolTest(unittest.TestCase):
+    def post(self, payload, after=b("")):
+        return request(b("POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n"
+                            % len(payload)) + payload + after)
+
+    def test_not_seekable(self):
+        body = self.post(b("abc")).body
+        self.assertFalse(body.seekable())
+        self.assertRaises(IOError, body.seek, 0)
+        self.assertRaises(IOError, body.tell)
+
+    def test_read_again(self):
+        lines = [b("line %d\n" % i) for i in range(100)]
+        body = self.post(b("").join(lines)).body
+        self.assertEqual(body.readline(), lines[0])
+        body.spool()
+        self.assertTrue(body.seekable())
+        self.assertEqual(body.tell(), 0)
+        self.assertEqual(list(body), lines[1:])
+        body.seek(0)
+        self.assertEqual(body.readline(), lines[1])
+        self.assertEqual(body.tell(), len(lines[1]))
+        self.assertEqual(body.read(), b("").join(lines[2:]))
+
+    def test_seek_forward_and_end(self):
+        payload = b("0123456789") * 10
+        body = self.post(payload).body
+        body.spool()
+        self.assertEqual(body.seek(50), 50)
+        self.assertEqual(body.read(5), payload[50:55])
+        self.assertEqual(body.seek(-5, 2), len(payload) - 5)
+        self.assertEqual(body.read(), payload[-5:])
+        self.assertEqual(body.seek(-10, 1), len(payload) - 10)
+        self.assertRaises(ValueError, body.seek, -1)
+
+    def test_spill_to_file(self):
+        payload = os.urandom(100000)
+        body = self.post(payload).body
+        body.spool(threshold=1024)
+        self.assertEqual(body.read(), payload)
+        self.assertTrue(body.reader.spool.map is not None)
+        body.seek(4096)
+        self.assertEqual(body.read(10), payload[4096:4106])
+
+    def test_chunked(self):
+        req = request(b("POST / HTTP/1.1\r\nTransfer-Encoding: chunked"
+                        "\r\n\r\n5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n"))
+        req.body.spool()
+        self.assertEqual(req.body.read(), b("hello world"))
+        req.body.seek(6)
+        self.assertEqual(req.body.read(), b("world"))
+
+    def test_discard(self):
+        req = self.post(b("x") * 1000, b("GET /next HTTP/1.1\r\n\r\n"))
+        req.body.spool(threshold=100)
+        req.body.read(10)
+        req.body.discard()
+        req.reset(req.unreader)
+        self.assertEqual(req.uri, b("/next"))
+
+
+class InflateTest(unittest.TestCase):
+    def bomb(self, after=b("")):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(b("\0") * (8 * 1024 * 1024))
+        data += compressor.flush()
+        return (b("POST / HTTP/1.1\r\nContent-Encoding: gzip\r\n"
+                    "Content-Length: %d\r\n\r\n" % len(data)) + data + after)
+
+    def test_limit(self):
+        req = request(self.bomb(), inflate_limit=1024 * 1024)
+        self.assertRaises(http.BodyTooLarge, req.body.read)
+
+    def test_discard(self):
+        after = b("GET /next HTTP/1.1\r\n\r\n")
+        req = request(self.bomb(after), inflate_limit=1024 * 1024)
+        req.body.read(10)
+        req.body.discard()
+        req.reset(req.unreader)
+        self.assertEqual(req.uri, b("/next"))
+
+
+if __name__ == '__main__':
+    unittest.main()
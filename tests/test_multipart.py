@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.http as http
+import wsgiref2.multipart as multipart
+
+from wsgiref2.testing import FakeSocket
+from wsgiref2.util import b
+
+BOUNDARY = b("----boundary0123")
+
+
+def form(*parts):
+    """\
+    Build a multipart body from (headers, data) pairs.
+    """
+    body = b("")
+    for headers, data in parts:
+        body += b("--") + BOUNDARY + b("\r\n")
+        for header in headers:
+            body += b(header) + b("\r\n")
+        body += b("\r\n") + data + b("\r\n")
+    return body + b("--") + BOUNDARY + b("--\r\n")
+
+
+def environ(body, ctype=None):
+    if ctype is None:
+        ctype = b("multipart/form-data; boundary=\"") + BOUNDARY + b("\"")
+    raw = (b("POST / HTTP/1.1\r\nContent-Type: ") + ctype +
+            b("\r\nContent-Length: %d\r\n\r\n" % len(body)) + body)
+    req = http.Request(http.Unreader(FakeSocket(raw, 1000)))
+    return {"http.headers": req.headers, "http.body": req.body}
+
+
+class ParamsTest(unittest.TestCase):
+    def test_quoted(self):
+        value, params = multipart.parse_params(
+            b('form-data; name="a\\"b"; filename=x.txt'))
+        self.assertEqual(value, b("form-data"))
+        self.assertEqual(params, {b("name"): b('a"b'),
+                                    b("filename"): b("x.txt")})
+
+    def test_boundary(self):
+        self.assertEqual(multipart.get_boundary(b("text/plain")), None)
+        self.assertRaises(http.ParseError, multipart.get_boundary,
+                            b("multipart/form-data"))
+        self.assertRaises(http.ParseError, multipart.get_boundary,
+                            b("multipart/form-data; boundary=") + b("x") * 201)
+
+
+class ParserTest(unittest.TestCase):
+    def test_fields_and_file(self):
+        upload = os.urandom(200000)
+        body = form(
+            (['Content-Disposition: form-data; name="title"'], b("hello")),
+            (['Content-Disposition: form-data; name="file"; '
+                'filename="data.bin"',
+                "Content-Type: application/octet-stream"], upload))
+        parts = list(multipart.parse(environ(body), spool_size=1024,
+                                        block_size=4096))
+        self.assertEqual([p.name for p in parts], [b("title"), b("file")])
+        self.assertEqual(parts[0].value, b("hello"))
+        self.assertEqual(parts[0].filename, None)
+        self.assertEqual(parts[0].content_type, None)
+        self.assertTrue(parts[0].in_memory)
+        self.assertEqual(parts[1].filename, b("data.bin"))
+        self.assertEqual(parts[1].content_type,
+                            b("application/octet-stream"))
+        self.assertFalse(parts[1].in_memory)
+        self.assertEqual(parts[1].read(), upload)
+        for part in parts:
+            part.close()
+
+    def test_delimiter_lookalike(self):
+        # Data that nearly matches the delimiter, split across reads.
+        data = (b("\r\n--") + BOUNDARY[:-1] + b("x")) * 500
+        body = form((['Content-Disposition: form-data; name="a"'], data))
+        parts = list(multipart.parse(environ(body), block_size=64))
+        self.assertEqual(parts[0].value, data)
+
+    def test_not_multipart(self):
+        env = environ(b("x=1"), b("application/x-www-form-urlencoded"))
+        self.assertRaises(http.ParseError, multipart.parse, env)
+
+    def test_truncated(self):
+        body = form((['Content-Disposition: form-data; name="a"'], b("x")))
+        parser = multipart.parse(environ(body[:-20]))
+        self.assertRaises(http.ParseError, list, parser)
+
+    def test_too_many_parts(self):
+        body = form(*[(['Content-Disposition: form-data; name="a"'], b("x"))
+                        for i in range(5)])
+        parser = multipart.parse(environ(body), max_parts=4)
+        self.assertRaises(http.ParseError, list, parser)
+
+
+if __name__ == '__main__':
+    unittest.main()
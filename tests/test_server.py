@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import socket
+import sys
+import threading
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.aio as aio
+import wsgiref2.server as server
+
+from wsgiref2.util import b
+
+
+def app(self, environ):
+    body = environ["http.uri.path"]
+    return 200, [(b("Content-Length"), b(str(len(body))))], [body]
+
+
+def read_app(self, environ):
+    environ["http.body"].read()
+    return 200, [(b("Content-Length"), b("0"))], []
+
+
+def start(cls, handler=app, **kwargs):
+    srv = type("Server", (cls,), {"app": handler})(("127.0.0.1", 0), **kwargs)
+    thread = threading.Thread(target=srv.run)
+    thread.daemon = True
+    thread.start()
+    return srv.sock.getsockname()
+
+
+def exchange(address, data, timeout=2):
+    sock = socket.create_connection(address, timeout)
+    try:
+        sock.sendall(data)
+        chunks = []
+        while True:
+            try:
+                chunk = sock.recv(65536)
+            except socket.timeout:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b("").join(chunks)
+    finally:
+        sock.close()
+
+
+class PipelineTest(unittest.TestCase):
+    def pipeline(self, cls, **kwargs):
+        address = start(cls, max_pipeline=4, **kwargs)
+        for count in (5, 9):
+            reqs = [b("GET /%d HTTP/1.1\r\n\r\n" % i) for i in range(count)]
+            reqs[-1] = b("GET /%d HTTP/1.1\r\nConnection: close\r\n\r\n"
+                            % (count - 1))
+            out = exchange(address, b("").join(reqs))
+            self.assertEqual(out.count(b("HTTP/1.1 200 OK")), count)
+            self.assertTrue(out.endswith(b("/%d" % (count - 1))))
+
+    def test_sync(self):
+        self.pipeline(server.HTTPServer)
+
+    def test_reactor(self):
+        self.pipeline(server.ReactorHTTPServer, threads=2)
+
+
+class BodyTooLargeTest(unittest.TestCase):
+    def closes(self, cls, **kwargs):
+        address = start(cls, read_app, inflate_limit=1024, **kwargs)
+        # Stored, so there's more than one inflate read of it.
+        compressor = zlib.compressobj(0, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(b("\0") * (1024 * 1024))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        # Far more is announced than is ever sent, so the server
+        # only gets to the end by closing instead of reading on.
+        head = b("POST / HTTP/1.1\r\nContent-Encoding: gzip\r\n"
+                    "Content-Length: 1000000000\r\n\r\n")
+        sock = socket.create_connection(address, 2)
+        try:
+            sock.sendall(head + data)
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            sock.close()
+        self.assertTrue(b("").join(chunks).startswith(b("HTTP/1.1 413 ")))
+
+    def test_sync(self):
+        self.closes(server.HTTPServer)
+
+    def test_reactor(self):
+        self.closes(server.ReactorHTTPServer, threads=2)
+
+    def test_asyncio(self):
+        self.closes(aio.AsyncHTTPServer, threads=2)
+
+
+class RejectTest(unittest.TestCase):
+    def test_503(self):
+        entered, release = threading.Event(), threading.Event()
+        def slow_app(self, environ):
+            entered.set()
+            release.wait(5)
+            return app(self, environ)
+        address = start(server.ThreadedHTTPServer, slow_app, threads=1,
+                            queue_size=1, overflow="reject")
+        busy = []
+        try:
+            # One connection keeps the worker busy, one fills the queue.
+            for i in range(2):
+                busy.append(socket.create_connection(address, 2))
+                busy[-1].sendall(b("GET / HTTP/1.1\r\n\r\n"))
+                entered.wait(2)
+            # The request is never read, so a plain close would reset
+            # the connection before the 503 could be read.
+            body = b("x") * 65536
+            out = exchange(address, b("POST / HTTP/1.1\r\n"
+                            "Content-Length: %d\r\n\r\n" % len(body)) + body)
+            self.assertTrue(out.startswith(b("HTTP/1.1 503 ")))
+        finally:
+            release.set()
+            for sock in busy:
+                sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.http as http
+import wsgiref2.static as static
+import wsgiref2.wsgi as wsgi
+
+from wsgiref2.testing import FakeSocket
+from wsgiref2.util import b
+
+
+def environ(target, *headers):
+    raw = b("\r\n").join([b("GET ") + b(target) + b(" HTTP/1.1")] +
+                            [b(h) for h in headers] + [b(""), b("")])
+    httpreq = http.Request(http.Unreader(FakeSocket(raw)))
+    return wsgi.Request(("127.0.0.1", 8000), ("127.0.0.1", 5000),
+                            FakeSocket(), httpreq).environ
+
+
+def header(headers, name):
+    for key, value in headers:
+        if key.lower() == b(name):
+            return value
+    return None
+
+
+def content(body):
+    return b("").join([bytes(data) for data in body])
+
+
+class StaticTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, "index.html"), "wb") as handle:
+            handle.write(b("<p>index</p>"))
+        os.mkdir(os.path.join(self.dir, "sub"))
+        with open(os.path.join(self.dir, "sub", "data.txt"), "wb") as handle:
+            handle.write(b("0123456789"))
+        self.app = static.Static(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_file(self):
+        status, headers, body = self.app(environ("/sub/data.txt"))
+        self.assertEqual(status, 200)
+        self.assertEqual(header(headers, "content-type"), b("text/plain"))
+        self.assertEqual(header(headers, "content-length"), b("10"))
+        self.assertEqual(content(body), b("0123456789"))
+
+    def test_index(self):
+        status, headers, body = self.app(environ("/"))
+        self.assertEqual(status, 200)
+        self.assertEqual(content(body), b("<p>index</p>"))
+
+    def test_absolute_form_without_path(self):
+        status, headers, body = self.app(environ("http://localhost"))
+        self.assertEqual(status, 200)
+        self.assertEqual(content(body), b("<p>index</p>"))
+
+    def test_directory_redirect(self):
+        status, headers, body = self.app(environ("/sub?x=1"))
+        self.assertEqual(status, 301)
+        self.assertEqual(header(headers, "location"), b("/sub/?x=1"))
+
+    def test_traversal(self):
+        for target in ("/../etc/passwd", "/sub/%2e%2e/%2e%2e/etc/passwd",
+                        "/sub/data.txt%00"):
+            status, headers, body = self.app(environ(target))
+            self.assertEqual(status, 404, target)
+
+    def test_single_range(self):
+        status, headers, body = self.app(environ("/sub/data.txt",
+                                                    "Range: bytes=2-4"))
+        self.assertEqual(status, 206)
+        self.assertEqual(header(headers, "content-range"), b("bytes 2-4/10"))
+        self.assertEqual(content(body), b("234"))
+
+    def test_multiple_ranges(self):
+        status, headers, body = self.app(environ("/sub/data.txt",
+                                                    "Range: bytes=0-1,-2"))
+        self.assertEqual(status, 206)
+        ctype = header(headers, "content-type")
+        self.assertTrue(ctype.startswith(b("multipart/byteranges")))
+        out = content(body)
+        self.assertEqual(header(headers, "content-length"), b(str(len(out))))
+        self.assertTrue(b("Content-Range: bytes 0-1/10\r\n\r\n01") in out)
+        self.assertTrue(b("Content-Range: bytes 8-9/10\r\n\r\n89") in out)
+
+    def test_unsatisfiable_range(self):
+        status, headers, body = self.app(environ("/sub/data.txt",
+                                                    "Range: bytes=20-"))
+        self.assertEqual(status, 416)
+        self.assertEqual(header(headers, "content-range"), b("bytes */10"))
+
+    def test_if_range_mismatch(self):
+        status, headers, body = self.app(environ("/sub/data.txt",
+                                "Range: bytes=2-4", 'If-Range: "other"'))
+        self.assertEqual(status, 200)
+        self.assertEqual(content(body), b("0123456789"))
+
+    def test_not_modified(self):
+        status, headers, body = self.app(environ("/sub/data.txt"))
+        etag = header(headers, "etag").decode("latin-1")
+        status, headers, body = self.app(environ("/sub/data.txt",
+                                                    "If-None-Match: " + etag))
+        self.assertEqual(status, 304)
+        self.assertEqual(list(body), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+
+import gzip
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsgiref2.http as http
+import wsgiref2.wsgi as wsgi
+
+from wsgiref2.testing import FakeSocket
+from wsgiref2.util import b
+
+
+def respond(raw, status, headers, body):
+    """\
+    Parse the request raw and send the response over a real
+    socket, so sendfile can be used. Returns what was sent.
+    """
+    httpreq = http.Request(http.Unreader(FakeSocket(raw)))
+    server, client = socket.socketpair()
+    try:
+        req = wsgi.Request(("127.0.0.1", 8000), ("127.0.0.1", 5000),
+                            server, httpreq)
+        req.respond(status, headers, body)
+        server.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+        return b("").join(chunks)
+    finally:
+        server.close()
+        client.close()
+
+
+class SendfileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "data.gz")
+        with gzip.open(self.path, "wb") as handle:
+            handle.write(b("hello"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def respond(self, body):
+        out = respond(b("GET / HTTP/1.1\r\n\r\n"), 200,
+                        [(b("Content-Length"), b("5"))], body)
+        return out.split(b("\r\n\r\n"), 1)[1]
+
+    def test_regular_file(self):
+        with open(self.path, "rb") as handle:
+            self.assertTrue(wsgi.is_file(handle))
+            data = handle.read()
+        body = wsgi.FileWrapper(open(self.path, "rb"), offset=1, length=4)
+        out = respond(b("GET / HTTP/1.1\r\n\r\n"), 200,
+                        [(b("Content-Length"), b("4"))], body)
+        self.assertEqual(out.split(b("\r\n\r\n"), 1)[1], data[1:5])
+
+    def test_seeked_file(self):
+        class Unmapped(wsgi.FileWrapper):
+            def is_file(self):
+                return False
+        with open(self.path, "wb") as handle:
+            handle.write(b("0123456789"))
+        for cls in (wsgi.FileWrapper, Unmapped):
+            handle = open(self.path, "rb")
+            handle.seek(4)
+            raw = b("GET / HTTP/1.1\r\n\r\n")
+            out = respond(raw, 200, [(b("Content-Length"), b("6"))],
+                            cls(handle))
+            self.assertEqual(out.split(b("\r\n\r\n"), 1)[1], b("456789"))
+
+    def test_pipe(self):
+        proc = subprocess.Popen([sys.executable, "-c",
+                                    "import sys; sys.stdout.write('hello')"],
+                                    stdout=subprocess.PIPE)
+        try:
+            self.assertFalse(wsgi.is_file(proc.stdout))
+            self.assertEqual(self.respond(proc.stdout), b("hello"))
+        finally:
+            proc.wait()
+
+    def test_gzip_file(self):
+        handle = gzip.open(self.path, "rb")
+        self.assertFalse(wsgi.is_file(handle))
+        self.assertEqual(self.respond(handle), b("hello"))
+
+    def test_gzip_file_wrapper(self):
+        body = wsgi.FileWrapper(gzip.open(self.path, "rb"))
+        self.assertFalse(body.is_file())
+        self.assertEqual(self.respond(body), b("hello"))
+
+
+class NoBodyTest(unittest.TestCase):
+    def respond(self, raw, status, body):
+        closed = []
+        class Body(object):
+            def __iter__(self):
+                return iter(body)
+            def close(self):
+                closed.append(True)
+        out = respond(raw, status, [], Body())
+        self.assertEqual(closed, [True])
+        return out
+
+    def test_head(self):
+        out = self.respond(b("HEAD / HTTP/1.1\r\n\r\n"), 200, [b("abcd")])
+        self.assertTrue(out.endswith(b("\r\n\r\n")))
+        self.assertFalse(b("abcd") in out)
+
+    def test_not_modified(self):
+        for status in (204, 304):
+            out = self.respond(b("GET / HTTP/1.1\r\n\r\n"), status,
+                                [b("abcd")])
+            self.assertTrue(out.endswith(b("\r\n\r\n")))
+
+    def test_head_file(self):
+        path = os.path.abspath(__file__)
+        body = wsgi.FileWrapper(open(path, "rb"))
+        size = os.path.getsize(path)
+        out = respond(b("HEAD / HTTP/1.1\r\n\r\n"), 200,
+                        [(b("Content-Length"), b(str(size)))], body)
+        self.assertTrue(out.endswith(b("\r\n\r\n")))
+        self.assertTrue(body.filelike.closed)
+
+
+class BodyTooLargeTest(unittest.TestCase):
+    def test_413(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(b("\0") * (4 * 1024 * 1024))
+        data += compressor.flush()
+        raw = (b("POST / HTTP/1.1\r\nContent-Encoding: gzip\r\n"
+                "Content-Length: %d\r\n\r\n" % len(data)) + data)
+        httpreq = http.Request(http.Unreader(FakeSocket(raw)),
+                                inflate_limit=1024)
+        server, client = socket.socketpair()
+        try:
+            req = wsgi.Request(("127.0.0.1", 8000), ("127.0.0.1", 5000),
+                                server, httpreq)
+            def app(environ):
+                environ["http.body"].read()
+                return 200, [], []
+            req.handle(app)
+            self.assertTrue(req.should_close())
+            self.assertTrue(client.recv(65536).startswith(
+                                b("HTTP/1.1 413 ")))
+        finally:
+            server.close()
+            client.close()
+
+
+class SyscallTest(unittest.TestCase):
+    def test_pipelined(self):
+        sock = FakeSocket()
+        writer = wsgi.ResponseWriter(sock)
+        reqs = []
+        for path in ("/a", "/b"):
+            raw = b("GET ") + b(path) + b(" HTTP/1.1\r\n\r\n")
+            httpreq = http.Request(http.Unreader(FakeSocket(raw)))
+            req = wsgi.Request(("127.0.0.1", 8000), ("127.0.0.1", 5000),
+                                sock, httpreq, writer=writer)
+            req.respond(200, [(b("Content-Length"), b("2"))], [b(path)])
+            reqs.append(req)
+        self.assertEqual(sock.sent, 0)
+        writer.flush()
+        self.assertEqual(sock.getvalue().count(b("HTTP/1.1 200 OK")), 2)
+        self.assertEqual([req.syscalls for req in reqs], [1, 1])
+        self.assertEqual(writer.waiting, [])
+
+
+class EnvironTest(unittest.TestCase):
+    def test_kept_past_reset(self):
+        unreader = http.Unreader(FakeSocket(b("").join([
+            b("GET /first?a HTTP/1.1\r\nHost: one:81\r\n\r\n"),
+            b("GET /second?b HTTP/1.1\r\nHost: two:82\r\n\r\n")
+        ])))
+        httpreq = http.Request(unreader)
+        args = [("127.0.0.1", 8000), ("127.0.0.1", 5000), None, httpreq]
+        req = wsgi.Request(*args)
+        environ = req.environ
+        httpreq.reset(unreader)
+        req.reset(*args)
+        self.assertEqual(environ["http.uri.path"], b("/first"))
+        self.assertEqual(environ["http.uri.query_string"], b("a"))
+        self.assertEqual(environ["conn.server_name"], b("one"))
+        self.assertEqual(environ["conn.server_port"], 81)
+        req.upgraded = True
+        self.assertFalse(environ["wsgi.upgraded"]())
+        self.assertTrue(req.environ["wsgi.upgraded"]())
+        self.assertEqual(req.environ["http.uri.path"], b("/second"))
+
+    def test_server_name_without_host(self):
+        raw = b("GET / HTTP/1.0\r\n\r\n")
+        httpreq = http.Request(http.Unreader(FakeSocket(raw)))
+        req = wsgi.Request(("127.0.0.1", 8000), ("127.0.0.1", 5000),
+                            None, httpreq)
+        self.assertEqual(req.environ["conn.server_name"], b("127.0.0.1"))
+        self.assertEqual(req.environ["conn.server_port"], 8000)
+
+
+if __name__ == '__main__':
+    unittest.main()
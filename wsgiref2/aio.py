@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+#
+# An asyncio backend for the server. Request heads are parsed on the
+# event loop and only complete requests are handed to a thread pool,
+# so an idle keep-alive connection costs a file descriptor instead of
+# a thread. Coroutine applications and asynchronous response bodies
+# run on the loop itself. This module requires Python 3.
+
+import asyncio
+import collections
+import inspect
+import sys
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+import wsgiref2.http as http
+import wsgiref2.server as server
+import wsgiref2.wsgi as wsgi
+
+from wsgiref2.util import b
+
+# Stop reading from a client when this much request body is
+# waiting for the application and start again below the low mark.
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+
+
+class Channel(object):
+    """\
+    A socket-like object that the event loop pushes received
+    bytes into. recv_into blocks the calling executor thread
+    until data arrives, which lets the blocking Unreader and
+    body readers from wsgiref2.http run on top of it as is.
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.cond = threading.Condition()
+        self.chunks = collections.deque()
+        self.size = 0
+        self.eof = False
+
+    def feed(self, data):
+        with self.cond:
+            self.chunks.append(memoryview(data))
+            self.size += len(data)
+            self.cond.notify()
+            return self.size
+
+    def feed_eof(self):
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def take(self):
+        with self.cond:
+            data = b("").join(self.chunks)
+            self.chunks.clear()
+            self.size = 0
+            return data
+
+    def recv_into(self, buf, nbytes=0):
+        view = memoryview(buf)
+        nbytes = nbytes or len(view)
+        with self.cond:
+            while not self.chunks and not self.eof:
+                self.cond.wait()
+            pos = 0
+            while self.chunks and pos < nbytes:
+                chunk = self.chunks[0]
+                count = min(len(chunk), nbytes - pos)
+                view[pos:pos + count] = chunk[:count]
+                if count == len(chunk):
+                    self.chunks.popleft()
+                else:
+                    self.chunks[0] = chunk[count:]
+                pos += count
+            self.size -= pos
+            if self.protocol.paused and self.size < LOW_WATER:
+                self.protocol.wakeup(self.protocol.resume)
+        return pos
+
+
+class Writer(object):
+    """\
+    Gives wsgi.Request the send/sendall interface it expects.
+    Writes from an executor thread are passed to the transport
+    on the event loop and block while the transport is paused.
+    Writes made on the loop go straight to the transport.
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.writable = threading.Event()
+        self.writable.set()
+        self.closed = False
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        if threading.get_ident() == self.protocol.server.thread_id:
+            if self.closed:
+                raise ConnectionResetError("Client disconnected.")
+            self.protocol.write(bytes(data))
+            return
+        self.writable.wait()
+        if self.closed:
+            raise ConnectionResetError("Client disconnected.")
+        self.protocol.wakeup(self.protocol.write, bytes(data))
+
+    def recv(self, size):
+        unreader = self.protocol.unreader
+        data = unreader.peek()[:size]
+        ret = bytes(data)
+        unreader.consume(len(ret))
+        return ret
+
+
+class AsyncBody(object):
+    """\
+    The http.body given to coroutine applications. It has the
+    same methods as http.Body but they are coroutines, and it
+    can be iterated with async for. Content-Length bodies are
+    read on the loop once enough bytes have arrived. Chunked
+    bodies are decoded on an executor thread.
+    """
+    def __init__(self, body, protocol):
+        self.body = body
+        self.protocol = protocol
+        self.buf = bytearray()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        line = await self.readline()
+        if not line:
+            raise StopAsyncIteration()
+        return line
+
+    async def read(self, size=None):
+        if size is None or size < 0:
+            chunks = [bytes(self.buf)]
+            del self.buf[:]
+            data = await self._read(65536)
+            while data:
+                chunks.append(data)
+                data = await self._read(65536)
+            return b("").join(chunks)
+        if size == 0:
+            return b("")
+        if self.buf:
+            ret = bytes(self.buf[:size])
+            del self.buf[:size]
+            return ret
+        return await self._read(size)
+
+    async def readline(self, size=None):
+        if size is None or size < 0:
+            size = sys.maxsize
+        scanned = 0
+        while True:
+            idx = self.buf.find(b("\n"), scanned, size)
+            if idx >= 0:
+                size = idx + 1
+                break
+            if len(self.buf) >= size:
+                break
+            scanned = len(self.buf)
+            data = await self._read(8192)
+            if not data:
+                break
+            self.buf += data
+        ret = bytes(self.buf[:size])
+        del self.buf[:size]
+        return ret
+
+    async def readlines(self, hint=None):
+        ret, total = [], 0
+        line = await self.readline()
+        while line:
+            ret.append(line)
+            total += len(line)
+            if hint is not None and 0 < hint <= total:
+                break
+            line = await self.readline()
+        return ret
+
+    async def discard(self):
+        del self.buf[:]
+        self.body.unwrap()
+        while await self._read(65536):
+            pass
+
+    async def _read(self, size):
+        body = self.body
+        if body.pre_read is not None:
+            body.pre_read()
+            body.pre_read = None
+        if isinstance(body.reader, http.LengthReader):
+            await self.protocol.wait_data(min(size, body.reader.length))
+            return body.read(size)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, body.read, size)
+
+
+class Request(wsgi.Request):
+    """\
+    A wsgi.Request that can also drive coroutine applications
+    and asynchronous response bodies from the event loop.
+    """
+    __slots__ = ("protocol", "pending")
+
+    def __init__(self, protocol, httpreq):
+        server = protocol.server
+        super(Request, self).__init__(server.address, protocol.peer,
+                protocol.writer, httpreq, multithread=True,
+                multiprocess=server.multiprocess,
+                coalesce_size=server.coalesce_size)
+        self.protocol = protocol
+        self.pending = None
+
+    def respond(self, status, headers, body):
+        # Asynchronous bodies can't be iterated on an executor
+        # thread so they are left for the loop to stream.
+        if hasattr(body, "__aiter__"):
+            self.pending = (status, headers, body)
+            return
+        super(Request, self).respond(status, headers, body)
+
+    async def handle_async(self, app):
+        try:
+            response = app(self.environ)
+            if inspect.isawaitable(response):
+                response = await response
+            if response is None:
+                return False
+            (status, headers, body) = response
+            await self.respond_async(status, headers, body)
+        except Exception:
+            if self.started:
+                raise
+            self.respond(*self.error_response())
+        return True
+
+    async def respond_async(self, status, headers, body):
+        self.write_head(status, headers)
+        try:
+            if not self.has_body(status):
+                # Nothing is sent, but the body is still closed.
+                pass
+            elif hasattr(body, "__aiter__"):
+                async for data in body:
+                    self.write(data)
+                    await self.protocol.drain()
+            else:
+                for data in body:
+                    self.write(data)
+                    await self.protocol.drain()
+            self.finish(getattr(body, "trailers", None))
+        finally:
+            if hasattr(body, "aclose"):
+                await body.aclose()
+            elif hasattr(body, "close"):
+                body.close()
+
+
+def is_async(app):
+    if inspect.iscoroutinefunction(app):
+        return True
+    return inspect.iscoroutinefunction(getattr(app, "__call__", None))
+
+
+class HTTPProtocol(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.loop = server.loop
+        self.transport = None
+        self.peer = None
+        self.parser = http.RequestParser()
+        self.channel = Channel(self)
+        self.unreader = http.Unreader(self.channel)
+        self.writer = Writer(self)
+        self.busy = False
+        self.paused = False
+        self.waiter = None
+        self.lingering = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info("peername")
+
+    def connection_lost(self, exc):
+        self.writer.closed = True
+        self.writer.writable.set()
+        self.channel.feed_eof()
+        self.notify()
+        if not self.busy:
+            self.unreader.close()
+
+    def data_received(self, data):
+        if self.lingering is not None:
+            self.lingering += len(data)
+            if self.lingering >= server.LINGER_SIZE:
+                self.close()
+            return
+        if not self.busy:
+            self.parse(data)
+            return
+        if self.channel.feed(data) > HIGH_WATER and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+        self.notify()
+
+    def eof_received(self):
+        if self.lingering is not None:
+            return False
+        self.channel.feed_eof()
+        self.notify()
+        # Keep the transport open to finish a response in flight.
+        return self.busy
+
+    def pause_writing(self):
+        self.writer.writable.clear()
+
+    def resume_writing(self):
+        self.writer.writable.set()
+        self.notify()
+
+    def notify(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def wait(self):
+        self.waiter = self.loop.create_future()
+        try:
+            await self.waiter
+        finally:
+            self.waiter = None
+
+    async def wait_data(self, size):
+        while len(self.unreader) + self.channel.size < size:
+            if self.channel.eof:
+                return
+            self.resume()
+            await self.wait()
+
+    async def drain(self):
+        while not self.writer.writable.is_set():
+            await self.wait()
+
+    def wakeup(self, func, *args):
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def write(self, data):
+        if not self.transport.is_closing():
+            self.transport.write(data)
+
+    def resume(self):
+        if self.paused and not self.transport.is_closing():
+            self.paused = False
+            self.transport.resume_reading()
+
+    def close(self):
+        self.transport.close()
+        self.unreader.close()
+
+    def linger(self):
+        """\
+        Close the connection the way server.linger does: send EOF
+        and drop what the client still sends until it closes too
+        or the LINGER_TIME and LINGER_SIZE limits are reached.
+        """
+        if not self.transport.can_write_eof():
+            self.close()
+            return
+        self.lingering = 0
+        self.transport.write_eof()
+        self.resume()
+        self.loop.call_later(server.LINGER_TIME, self.close)
+
+    def parse(self, data):
+        try:
+            used = self.parser.feed(data)
+        except http.ParseError:
+            traceback.print_exc()
+            self.close()
+            return
+        if self.parser.next_event() is http.NEED_DATA:
+            return
+        if used < len(data):
+            self.channel.feed(data[used:])
+        self.busy = True
+        parser, self.parser = self.parser, http.RequestParser()
+        task = self.loop.create_task(self.handle(parser))
+        task.add_done_callback(self.finished)
+
+    async def handle(self, parser):
+        """\
+        Serve one request. Returns True when the connection must
+        be closed afterwards.
+        """
+        httpreq = http.Request(self.unreader, parser=parser,
+                    inflate_limit=self.server.inflate_limit)
+        req = Request(self, httpreq)
+        app = self.server.app
+        if is_async(app):
+            body = AsyncBody(httpreq.body, self)
+            req.environ["http.body"] = body
+            if not await req.handle_async(app):
+                return True
+            if req.should_close():
+                return True
+            await body.discard()
+        else:
+            if not await self.loop.run_in_executor(None, self.run, req, app):
+                return True
+            if req.pending is not None:
+                await req.respond_async(*req.pending)
+        return req.should_close()
+
+    def run(self, req, app):
+        # Runs on an executor thread.
+        if not req.handle(app):
+            return False
+        # The rest of the body isn't read on a connection that closes.
+        if not req.should_close():
+            req.httpreq.body.discard()
+        return True
+
+    def finished(self, future):
+        self.busy = False
+        if future.exception() is not None:
+            exc = future.exception()
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+            self.close()
+            return
+        if self.transport.is_closing():
+            self.close()
+            return
+        if future.result():
+            # The rest of the request isn't read, only drained.
+            self.linger()
+            return
+
+        # Anything left over is the start of a pipelined request.
+        data = b("")
+        if len(self.unreader):
+            data = self.unreader.read(len(self.unreader))
+        data += self.channel.take()
+        self.resume()
+        if data:
+            self.parse(data)
+        elif self.channel.eof:
+            self.close()
+
+
+class AsyncHTTPServer(server.HTTPServer):
+    """\
+    Serves connections from an asyncio event loop. Request
+    heads are parsed on the loop and each complete request is
+    run on a pool of executor threads, so idle keep-alive
+    connections don't hold a thread.
+    """
+    def __init__(self, address, threads=8, **kwargs):
+        super(AsyncHTTPServer, self).__init__(address, **kwargs)
+        self.threads = threads
+        self.multithread = True
+        self.loop = None
+        self.thread_id = None
+
+    def serve(self):
+        self.thread_id = threading.get_ident()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(ThreadPoolExecutor(self.threads))
+        factory = lambda: HTTPProtocol(self)
+        listener = self.loop.run_until_complete(
+            self.loop.create_server(factory, sock=self.sock))
+        try:
+            self.loop.run_forever()
+        finally:
+            listener.close()
+            self.loop.run_until_complete(listener.wait_closed())
+            self.loop.close()
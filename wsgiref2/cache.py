@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+#
+# Middleware that keeps complete GET and HEAD responses in memory and
+# answers repeated requests for them without calling the application,
+# including 304 replies to If-None-Match revalidations.
+
+import time
+
+from wsgiref2.util import b, LRUCache
+
+# Total bytes of cached responses.
+CACHE_SIZE = 64 * 1024 * 1024
+
+# Bodies larger than this aren't stored.
+MAX_ENTRY = 1024 * 1024
+
+# Number of distinct URIs whose Vary headers are remembered.
+MAX_URIS = 65536
+
+CACHEABLE_STATUS = (200, 203, 204, 300, 301, 404, 410)
+
+# Headers that describe the connection rather than the response.
+HOP_BY_HOP = (
+    b("connection"),
+    b("keep-alive"),
+    b("transfer-encoding"),
+    b("age")
+)
+
+# Headers sent with a 304 response.
+NOT_MODIFIED_HEADERS = (
+    b("cache-control"),
+    b("content-location"),
+    b("date"),
+    b("etag"),
+    b("expires"),
+    b("vary"),
+    b("age")
+)
+
+
+def parse_cache_control(values):
+    """\
+    Parse Cache-Control header values into a dict of lower case
+    directives to their values, None for bare directives.
+    """
+    ret = {}
+    for value in values:
+        for item in value.split(b(",")):
+            name, sep, arg = item.partition(b("="))
+            name = name.strip().lower()
+            if name:
+                ret[name] = sep and arg.strip().strip(b('"')) or None
+    return ret
+
+
+def etag_matches(etag, values):
+    """\
+    Weak comparison of etag against If-None-Match values.
+    """
+    etag = etag[2:] if etag.startswith(b("W/")) else etag
+    for value in values:
+        for tag in value.split(b(",")):
+            tag = tag.strip()
+            if tag == b("*"):
+                return True
+            if tag.startswith(b("W/")):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+    return False
+
+
+class Entry(object):
+    __slots__ = ("status", "headers", "body", "etag", "stored", "expires",
+                    "size")
+
+    def __init__(self, status, headers, body, max_age):
+        self.status = status
+        self.headers = []
+        self.etag = None
+        self.size = len(body)
+        for name, value in headers:
+            lname = name.lower()
+            if lname in HOP_BY_HOP:
+                continue
+            if lname == b("etag"):
+                self.etag = value
+            self.headers.append((name, value))
+            self.size += len(name) + len(value)
+        self.body = body
+        self.stored = time.time()
+        self.expires = self.stored + max_age
+
+
+class CachingBody(object):
+    """\
+    Passes a streamed response body through while keeping a
+    copy. The response is stored once the body has been sent
+    in full, unless it turned out to be larger than max_entry.
+    """
+    def __init__(self, cache, key, status, headers, max_age, body, flush):
+        self.cache = cache
+        self.key = key
+        self.status = status
+        self.headers = headers
+        self.max_age = max_age
+        self.body = body
+        self.flush = flush
+        self.chunks = []
+        self.size = 0
+        self.complete = False
+
+    @property
+    def trailers(self):
+        return getattr(self.body, "trailers", None)
+
+    def __iter__(self):
+        for data in self.body:
+            if self.chunks is not None and data is not self.flush:
+                self.size += len(data)
+                if self.size > self.cache.max_entry:
+                    self.chunks = None
+                else:
+                    self.chunks.append(data)
+            yield data
+        self.complete = True
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            if self.complete and self.chunks is not None:
+                self.cache.store(self.key, self.status, self.headers,
+                                    b("").join(self.chunks), self.max_age)
+
+
+class Cache(object):
+    """\
+    Caches the responses of app. GET and HEAD responses with a
+    cacheable status and a Cache-Control max-age or s-maxage
+    are stored, keyed on the method, http.uri.raw and the
+    request headers named by their Vary header. Entries are
+    evicted least recently used first once they exceed
+    cache_size bytes and are dropped when they expire.
+
+    A cached response is replayed without calling app, and a
+    request whose If-None-Match matches its ETag gets a 304.
+    Requests with an Authorization header or that ask for a
+    fresh response with Cache-Control or Pragma always go
+    to app.
+    """
+    def __init__(self, app, cache_size=CACHE_SIZE, max_entry=MAX_ENTRY,
+                    max_uris=MAX_URIS):
+        self.app = app
+        self.max_entry = max_entry
+        self.entries = LRUCache(cache_size, weigh=lambda e: e.size)
+        self.vary = LRUCache(max_uris)
+
+    def __call__(self, environ):
+        method = environ["http.method"]
+        headers = environ["http.headers"]
+        if method not in (b("GET"), b("HEAD")) or self.bypass(headers):
+            return self.app(environ)
+
+        base = (method, environ["http.uri.raw"])
+        names = self.vary.get(base)
+        if names is not None:
+            key = self.key(base, names, headers)
+            entry = self.entries.get(key)
+            if entry is not None:
+                now = time.time()
+                if now < entry.expires:
+                    return self.replay(entry, headers, now)
+                self.entries.pop(key)
+
+        response = self.app(environ)
+        if response is None:
+            return response
+        status, rheaders, body = response
+        policy = self.policy(status, rheaders)
+        if policy is None or hasattr(body, "fileno"):
+            return response
+
+        max_age, names = policy
+        self.vary.put(base, names)
+        key = self.key(base, names, headers)
+        if isinstance(body, (list, tuple)):
+            try:
+                data = b("").join(body)
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+            if len(data) <= self.max_entry:
+                self.store(key, status, rheaders, data, max_age)
+            return status, rheaders, [data]
+        return status, rheaders, CachingBody(self, key, status, rheaders,
+                        max_age, body, environ.get("wsgi.flush"))
+
+    def bypass(self, headers):
+        if b("authorization") in headers:
+            return True
+        directives = parse_cache_control(headers.get(b("cache-control"), ()))
+        if b("no-cache") in directives or b("no-store") in directives:
+            return True
+        for value in headers.get(b("pragma"), ()):
+            if b("no-cache") in value.lower():
+                return True
+        return False
+
+    def key(self, base, names, headers):
+        return base + tuple(tuple(headers.get(name, ())) for name in names)
+
+    def policy(self, status, headers):
+        """\
+        Return (max_age, vary_names) when a response may be stored
+        or None otherwise.
+        """
+        if status not in CACHEABLE_STATUS:
+            return None
+        control, names = [], []
+        for name, value in headers:
+            lname = name.lower()
+            if lname == b("cache-control"):
+                control.append(value)
+            elif lname == b("set-cookie"):
+                return None
+            elif lname == b("vary"):
+                for vname in value.split(b(",")):
+                    vname = vname.strip().lower()
+                    if vname == b("*"):
+                        return None
+                    if vname:
+                        names.append(vname)
+        directives = parse_cache_control(control)
+        for directive in (b("no-store"), b("no-cache"), b("private")):
+            if directive in directives:
+                return None
+        max_age = directives.get(b("s-maxage"), directives.get(b("max-age")))
+        try:
+            max_age = int(max_age)
+        except (TypeError, ValueError):
+            return None
+        if max_age <= 0:
+            return None
+        return max_age, tuple(sorted(set(names)))
+
+    def store(self, key, status, headers, body, max_age):
+        self.entries.put(key, Entry(status, headers, body, max_age))
+
+    def replay(self, entry, headers, now):
+        age = (b("Age"), b(str(int(now - entry.stored))))
+        inm = headers.get(b("if-none-match"))
+        if inm and entry.etag is not None and etag_matches(entry.etag, inm):
+            ret = [(name, value) for (name, value) in entry.headers
+                    if name.lower() in NOT_MODIFIED_HEADERS]
+            ret.append(age)
+            return 304, ret, []
+        return entry.status, entry.headers + [age], [entry.body]
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+#
+# Middleware that compresses response bodies with gzip or deflate
+# when the client accepts it. Streamed bodies are compressed as they
+# are produced. Bodies given as a list are compressed whole and the
+# result is cached by a hash of their content, so a response that
+# repeats is only compressed once.
+
+import hashlib
+import zlib
+
+from wsgiref2.util import b, LRUCache
+
+# Bodies smaller than this aren't worth the headers and CPU time.
+MIN_SIZE = 1024
+
+# Give up on bodies whose first block shrinks by less than this.
+MIN_RATIO = 0.9
+
+# Total size of the compressed bodies kept in the cache.
+CACHE_SIZE = 16 * 1024 * 1024
+
+LEVEL = 6
+
+# Media types that are compressed, by prefix.
+TYPES = (
+    b("text/"),
+    b("application/json"),
+    b("application/javascript"),
+    b("application/xml"),
+    b("application/xhtml+xml"),
+    b("application/rss+xml"),
+    b("application/atom+xml"),
+    b("image/svg+xml")
+)
+
+WBITS = {
+    b("gzip"): 16 + zlib.MAX_WBITS,
+    b("deflate"): zlib.MAX_WBITS
+}
+
+
+def parse_accept(values):
+    """\
+    Parse Accept-Encoding header values into a dict of lower
+    case content codings to their q values.
+    """
+    ret = {}
+    for value in values:
+        for item in value.split(b(",")):
+            parts = item.split(b(";"))
+            coding = parts[0].strip().lower()
+            if not coding:
+                continue
+            q = 1.0
+            for param in parts[1:]:
+                name, sep, val = param.partition(b("="))
+                if name.strip().lower() == b("q"):
+                    try:
+                        q = float(val.strip())
+                    except ValueError:
+                        q = 0.0
+            ret[coding] = q
+    return ret
+
+
+def choose(values):
+    """\
+    Pick the coding to use from the Accept-Encoding values,
+    preferring gzip when the client is indifferent. Returns
+    None if neither gzip nor deflate is acceptable.
+    """
+    accept = parse_accept(values)
+    best, best_q = None, 0.0
+    for coding in (b("gzip"), b("deflate")):
+        q = accept.get(coding, accept.get(b("*"), 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class Body(object):
+    """\
+    Base for the bodies returned by Compress. It yields the
+    blocks read ahead from the application's body before the
+    rest of it and passes close() and trailers through.
+    """
+    def __init__(self, head, rest, body):
+        self.head = head
+        self.rest = rest
+        self.body = body
+
+    @property
+    def trailers(self):
+        return getattr(self.body, "trailers", None)
+
+    def __iter__(self):
+        for data in self.head:
+            yield data
+        for data in self.rest:
+            yield data
+
+    def close(self):
+        if hasattr(self.body, "close"):
+            self.body.close()
+
+
+class CompressedBody(Body):
+    def __init__(self, head, rest, body, compressor, flush):
+        super(CompressedBody, self).__init__(head, rest, body)
+        self.compressor = compressor
+        self.flush = flush
+
+    def __iter__(self):
+        compressor = self.compressor
+        for data in self.head:
+            yield data
+        for data in self.rest:
+            if data is self.flush:
+                yield compressor.flush(zlib.Z_SYNC_FLUSH)
+                yield data
+                continue
+            data = compressor.compress(data)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+class Compress(object):
+    """\
+    Compresses the responses of app for clients that send an
+    Accept-Encoding allowing gzip or deflate. Only media types
+    starting with one of types are compressed. levels maps
+    media types to a compression level overriding level, and a
+    level of 0 turns compression off for that type.
+
+    Responses smaller than min_size, ranges, responses that
+    already have a Content-Encoding and bodies that don't
+    compress are sent as they are.
+    """
+    def __init__(self, app, level=LEVEL, levels=None, types=TYPES,
+                    min_size=MIN_SIZE, cache_size=CACHE_SIZE):
+        self.app = app
+        self.level = level
+        self.levels = levels or {}
+        self.types = tuple(types)
+        self.min_size = min_size
+        self.cache = LRUCache(cache_size, weigh=len)
+
+    def __call__(self, environ):
+        response = self.app(environ)
+        if response is None:
+            return response
+        status, headers, body = response
+        if not self.eligible(environ, status, headers):
+            return response
+        level = self.get_level(headers)
+        if not level:
+            return response
+        coding = choose(environ["http.headers"].get(b("accept-encoding"), ()))
+        if coding is None:
+            # Caches must still know the response is negotiated.
+            return status, self.vary_headers(headers), body
+
+        if isinstance(body, (list, tuple)):
+            return self.compress_all(status, headers, body, coding, level)
+
+        # Read enough of the body to decide whether it's worth it,
+        # but no further than a flush, which must reach the client
+        # without waiting for the application to produce more.
+        flush = environ.get("wsgi.flush")
+        rest = iter(body)
+        head, size = [], 0
+        for data in rest:
+            if data is flush:
+                break
+            head.append(data)
+            size += len(data)
+            if size >= self.min_size:
+                break
+        else:
+            return status, self.vary_headers(headers), Body(head, (), body)
+
+        raw = b("").join(head)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+        first = [compressor.compress(raw) +
+                    compressor.flush(zlib.Z_SYNC_FLUSH)]
+        if data is flush:
+            head.append(flush)
+            first.append(flush)
+        if len(first[0]) > len(raw) * MIN_RATIO:
+            return status, self.vary_headers(headers), Body(head, rest, body)
+        headers = self.encoded_headers(headers, coding)
+        return status, headers, CompressedBody(first, rest, body,
+                                                compressor, flush)
+
+    def compress_all(self, status, headers, body, coding, level):
+        try:
+            data = b("").join(body)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+        # Whatever the outcome the response depends on Accept-Encoding.
+        if len(data) < self.min_size:
+            return status, self.vary_headers(headers), [data]
+
+        # An empty entry records a body that doesn't compress.
+        key = (hashlib.sha1(data).digest(), coding, level)
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+            compressed = compressor.compress(data) + compressor.flush()
+            if len(compressed) > len(data) * MIN_RATIO:
+                compressed = b("")
+            self.cache.put(key, compressed)
+        if not compressed:
+            return status, self.vary_headers(headers), [data]
+
+        headers = self.encoded_headers(headers, coding)
+        headers.append((b("Content-Length"), b(str(len(compressed)))))
+        return status, headers, [compressed]
+
+    def eligible(self, environ, status, headers):
+        if status < 200 or status in (204, 206, 304):
+            return False
+        if environ["http.method"] == b("HEAD"):
+            return False
+        ctype = None
+        for name, value in headers:
+            name = name.lower()
+            if name == b("content-encoding"):
+                return False
+            elif name == b("content-length"):
+                try:
+                    if int(value) < self.min_size:
+                        return False
+                except ValueError:
+                    return False
+            elif name == b("cache-control"):
+                if b("no-transform") in value.lower():
+                    return False
+            elif name == b("content-type"):
+                ctype = value.split(b(";"), 1)[0].strip().lower()
+        return ctype is not None and ctype.startswith(self.types)
+
+    def get_level(self, headers):
+        for name, value in headers:
+            if name.lower() == b("content-type"):
+                ctype = value.split(b(";"), 1)[0].strip().lower()
+                return self.levels.get(ctype, self.level)
+        return self.level
+
+    def vary_headers(self, headers):
+        ret, vary = [], False
+        for name, value in headers:
+            if name.lower() == b("vary"):
+                vary = True
+                if b("accept-encoding") not in value.lower():
+                    value += b(", Accept-Encoding")
+            ret.append((name, value))
+        if not vary:
+            ret.append((b("Vary"), b("Accept-Encoding")))
+        return ret
+
+    def encoded_headers(self, headers, coding):
+        ret = []
+        for name, value in self.vary_headers(headers):
+            lname = name.lower()
+            if lname == b("content-length"):
+                continue
+            elif lname == b("etag") and not value.startswith(b("W/")):
+                # The encoded body is a different representation.
+                value = b("W/") + value
+            ret.append((name, value))
+        ret.append((b("Content-Encoding"), coding))
+        return ret
@@ -3,14 +3,51 @@
 # This file is part of wsgiref2 released under the MIT license. 
 # See the NOTICE for more information.
 
-import os
+import mmap
 import re
 import sys
+import tempfile
+import threading
+import zlib
 
-
-from wsgiref2.util import b, BufferIO
+from wsgiref2.util import b, INT_TYPES
 import wsgiref2.uri as uri
 
+REQUEST_LINE, HEADERS, DONE = range(3)
+CHUNK_SIZE, CHUNK_DATA, CHUNK_END, CHUNK_TRAILERS, CHUNK_DONE = range(5)
+
+# Bounds on the size of reads a Body makes from its reader.
+READ_SIZE = 8192
+MAX_READ = 1024 * 1024
+
+# Spooled bodies move from memory to a temporary file past this size.
+SPOOL_SIZE = 1024 * 1024
+
+# Content codings that can be inflated and their zlib window bits.
+# Deflate bodies may or may not have the zlib header, see InflateReader.
+INFLATE_WBITS = {
+    b("gzip"): 16 + zlib.MAX_WBITS,
+    b("x-gzip"): 16 + zlib.MAX_WBITS,
+    b("deflate"): zlib.MAX_WBITS
+}
+
+NEED_DATA = "NEED_DATA"
+REQUEST = "REQUEST"
+
+LINE_END_RE = re.compile(b("\n"))
+# Only bare hex digits, so "0x5", "+5" and "5_0" are refused rather
+# than read differently from a proxy in front of us.
+CHUNK_SIZE_RE = re.compile(b("[0-9A-Fa-f]{1,16}$"))
+METHOD_RE = re.compile(b("[A-Z0-9$-_.]{3,20}"))
+VERSION_RE = re.compile(b("HTTP/(\d+).(\d+)"))
+HEADER_NAME_RE = re.compile(b("[\x00-\x1F\x7F()<>@,;:\[\]={} \t\\\\\"]"))
+
+# Header names as received mapped to a shared lower case copy so
+# that every request carrying a common header reuses one object.
+# New spellings stop being remembered once MAX_NAMES are known.
+MAX_NAMES = 1024
+NAMES = {}
+
 class ParseError(Exception):
     """\
     A simple class for reporting errors that occur
@@ -23,56 +60,174 @@ class ParseError(Exception):
         return "<ParseError: %s>" % self.error
 
 
+class BodyTooLarge(ParseError):
+    """\
+    Raised when a request body decompresses to more than the
+    inflate limit. Servers answer it with a 413.
+    """
+
+
+class NoMoreData(Exception):
+    """\
+    Raised when a client closes its connection cleanly
+    instead of sending another request.
+    """
+
+
+class BufferPool(object):
+    """\
+    A pool of fixed size receive buffers that is shared
+    between connections. Buffers are handed back when a
+    connection closes so that a busy server isn't forced
+    to allocate fresh storage for every client.
+    """
+    def __init__(self, size=8192, max_free=256):
+        self.size = size
+        self.max_free = max_free
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.size)
+
+    def release(self, buf):
+        if len(buf) != self.size:
+            return
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buf)
+
+POOL = BufferPool()
+
+
 class Unreader(object):
     """\
     An Unreader is an object that can have previously read
     bytes pushed back into it to be re-read. This helps so
     that we don't have to read bytes one at a time.
+
+    Buffered bytes live in a bytearray borrowed from a
+    BufferPool that is filled in place with recv_into. The
+    buffer is compacted rather than wrapped so the pending
+    bytes can always be exposed as a single memoryview. The
+    same storage is reused for every request on a connection
+    until close() gives it back to the pool.
     """
-    def __init__(self, sock, max_chunk=8192):
+    def __init__(self, sock, max_chunk=8192, pool=None):
         self.sock = sock
         self.max_chunk = max_chunk
-        self.buf = BufferIO()
-    
-    def _data(self):
-        return self.sock.recv(self.max_chunk)
-    
+        self.pool = pool or POOL
+        self.buf = self.pool.acquire()
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def fill(self):
+        """\
+        Receive more bytes from the socket into the free space
+        after the buffered data. Returns the number of bytes
+        received which is zero once the peer has closed.
+        """
+        if self.end == len(self.buf):
+            self._reserve(self.max_chunk)
+        size = min(len(self.buf) - self.end, self.max_chunk)
+        view = memoryview(self.buf)[self.end:self.end + size]
+        count = self.sock.recv_into(view, size)
+        self.end += count
+        return count
+
+    def peek(self):
+        """\
+        Return a memoryview of the buffered bytes, receiving
+        from the socket first if nothing is buffered. The view
+        is only valid until the next call on this object.
+        """
+        if self.start == self.end:
+            self.fill()
+        return memoryview(self.buf)[self.start:self.end]
+
+    def consume(self, size):
+        self.start = min(self.start + size, self.end)
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) != self.pool.size:
+                self.buf = self.pool.acquire()
+
+    def _reserve(self, size):
+        pending = self.end - self.start
+        buf = self.buf
+        if pending + size > len(buf):
+            buf = bytearray(max(pending + size, len(buf) * 2))
+        buf[:pending] = bytes(memoryview(self.buf)[self.start:self.end])
+        self.buf = buf
+        self.start, self.end = 0, pending
+
     def unread(self, data):
-        self.buf.seek(0, os.SEEK_END)
-        self.buf.write(data)
-    
+        size = len(data)
+        if not size:
+            return
+        if size <= self.start:
+            self.start -= size
+            self.buf[self.start:self.start + size] = data
+            return
+        data = bytes(data)
+        self._reserve(size)
+        self.buf[size:size + self.end] = self.buf[:self.end]
+        self.buf[:size] = data
+        self.end += size
+
+    def readinto(self, buf):
+        """\
+        Read up to len(buf) bytes into buf. Buffered bytes are
+        copied out first. When nothing is buffered and buf is
+        large, the socket reads directly into it.
+        """
+        view = memoryview(buf)
+        if not len(view):
+            return 0
+        if self.start == self.end and len(view) >= self.max_chunk:
+            return self.sock.recv_into(view, len(view))
+        if self.start == self.end and not self.fill():
+            return 0
+        size = min(len(view), self.end - self.start)
+        view[:size] = memoryview(self.buf)[self.start:self.start + size]
+        self.consume(size)
+        return size
+
     def read(self, size=None):
-        if size is not None and not isinstance(size, (int, long)):
+        if size is not None and not isinstance(size, INT_TYPES):
             raise TypeError("size parameter must be an int or long.")
         if size == 0:
-            return ""
+            return b("")
         if size is None or size < 0:
-            size = None
+            if self.start == self.end and not self.fill():
+                return b("")
+            size = self.end - self.start
 
-        self.buf.seek(0, os.SEEK_END)
-
-        if size is None and self.buf.tell():
-            ret = self.buf.getvalue()
-            self.buf.truncate(0)
-            self.buf.seek(0)
+        if size <= self.end - self.start:
+            ret = bytes(memoryview(self.buf)[self.start:self.start + size])
+            self.consume(size)
             return ret
-        if size is None:
-            return self._data()
 
-        while self.buf.tell() < size:
-            data = self._data()
-            if not len(data):
-                ret = self.buf.getvalue()
-                self.buf.truncate(0)
-                self.buf.seek(0)
-                return ret
-            self.buf.write(data)
+        ret = bytearray(size)
+        pos = 0
+        while pos < size:
+            count = self.readinto(memoryview(ret)[pos:])
+            if not count:
+                break
+            pos += count
+        del ret[pos:]
+        return bytes(ret)
 
-        data = self.buf.getvalue()
-        self.buf.truncate(0)
-        self.buf.seek(0)
-        self.buf.write(data[size:])
-        return data[:size]
+    def close(self):
+        self.pool.release(self.buf)
+        self.buf = bytearray(0)
+        self.start = self.end = 0
 
 
 class LengthReader(object):
@@ -81,34 +236,37 @@ class LengthReader(object):
     number of bytes. Used for parsing request bodies that
     aren't passed using cunked encoding.
     """
+    __slots__ = ("unreader", "length")
+
     def __init__(self, unreader, length):
+        self.reset(unreader, length)
+
+    def reset(self, unreader, length):
         self.unreader = unreader
         self.length = length
     
     def read(self, size):
-        if not isinstance(size, (int, long)):
+        if not isinstance(size, INT_TYPES):
             raise TypeError("size must be an integral type")
         
         size = min(self.length, size)
         if size < 0:
             raise ValueError("Size must be positive.")
         if size == 0:
-            return ""
-        
-        buf = BufferIO()
-        data = self.unreader.read()
-        while data:
-            buf.write(data)
-            if buf.tell() >= size:
-                break
-            data = self.unreader.read()
+            return b("")
         
-        buf = buf.getvalue()
-        ret, rest = buf[:size], buf[size:]
-        self.unreader.unread(rest)
-        self.length -= size
+        ret = self.unreader.read(size)
+        self.length -= len(ret)
         return ret
 
+    def readinto(self, buf):
+        view = memoryview(buf)[:self.length]
+        if not len(view):
+            return 0
+        count = self.unreader.readinto(view)
+        self.length -= count
+        return count
+
 
 class ChunkedReader(object):
     """\
@@ -116,11 +274,28 @@ class ChunkedReader(object):
     that uses chunked transfer encoding. Also attempts to
     parse any trailers that may be present setting them on
     the request instance.
+
+    Decoding is a state machine driven straight off the
+    Unreader's buffer, so a single receive can hold any number
+    of chunks and chunk data is copied once, directly into
+    the caller's buffer.
     """
+    __slots__ = ("unreader", "req", "state", "remaining", "line",
+                    "trailer_parser", "trailer_handler")
+
+    max_line = 8190
+
     def __init__(self, unreader, req):
-        self.parser = self.parse_chunked(unreader)
+        self.line = bytearray()
+        self.reset(unreader, req)
+
+    def reset(self, unreader, req):
+        self.unreader = unreader
         self.req = req
-        self.buf = BufferIO()
+        self.state = CHUNK_SIZE
+        self.remaining = 0
+        del self.line[:]
+        self.trailer_parser = None
         self.trailer_handler = None
 
     def set_trailer_handler(self, func):
@@ -129,107 +304,313 @@ class ChunkedReader(object):
         self.trailer_handler = func
 
     def read(self, size):
-        if not isinstance(size, (int, long)):
+        if not isinstance(size, INT_TYPES):
             raise TypeError("size must be an integral type")
-        if size <= 0:
+        if size < 0:
             raise ValueError("Size must be positive.")
-        if size == 0:
-            return ""
-
-        if self.parser:
-            while self.buf.tell() < size:
-                try:
-                    self.buf.write(self.parser.next())
-                except StopIteration:
-                    self.parser = None
-                    break
+        if size == 0 or self.state == CHUNK_DONE:
+            return b("")
+        buf = bytearray(min(size, MAX_READ))
+        count = self.readinto(buf)
+        del buf[count:]
+        return bytes(buf)
 
-        data = self.buf.getvalue()
-        ret, rest = data[:size], data[size:]
-        self.buf.truncate(0)
-        self.buf.seek(0)
-        self.buf.write(rest)
-        return ret
-    
-    def parse_trailers(self, unreader, data):
-        buf = BufferIO()
-        buf.write(data)
-        
-        idx = buf.getvalue().find("\r\n\r\n")
-        done = buf.getvalue()[:2] == "\r\n"
-        while idx < 0 and not done:
-            self.get_data(unreader, buf)
-            idx = buf.getvalue().find("\r\n\r\n")
-            done = buf.getvalue()[:2] == "\r\n"
-        if done:
-            unreader.unread(buf.getvalue()[2:])
-            return ""
-        self.req.trailers = self.req.parse_headers(buf.getvalue()[:idx])
-        if self.trailer_handler is not None:
-            self.trailer_handler(self.req.trailers)
-        unreader.unread(buf.getvalue()[idx+4:])
-
-    def parse_chunked(self, unreader):
-        (size, rest) = self.parse_chunk_size(unreader)
-        while size > 0:
-            while size > len(rest):
-                size -= len(rest)
-                yield rest
-                rest = unreader.read()
-                if not rest:
-                    raise ParseError("Client disconected during chunk.")
-            yield rest[:size]
-            # Remove \r\n after chunk
-            rest = rest[size:]
-            while len(rest) < 2:
-                rest += unreader.read()
-            if rest[:2] != '\r\n':
+    def readinto(self, buf):
+        """\
+        Decode body data into buf and return the number of bytes
+        written, which is zero once the last chunk and trailers
+        have been read. Once some data has been decoded this
+        returns rather than wait for the client to send more.
+        """
+        view = memoryview(buf)
+        pos, size = 0, len(view)
+        while pos < size and self.state != CHUNK_DONE:
+            if pos and not len(self.unreader):
+                break
+            if self.state != CHUNK_DATA:
+                self.parse_framing()
+                continue
+            count = min(size - pos, self.remaining)
+            count = self.unreader.readinto(view[pos:pos + count])
+            if not count:
+                raise ParseError("Client disconnected during chunk.")
+            pos += count
+            self.remaining -= count
+            if not self.remaining:
+                self.state = CHUNK_END
+        return pos
+
+    def parse_framing(self):
+        if self.state == CHUNK_TRAILERS:
+            self.parse_trailers()
+            return
+        line = self.read_line()
+        if self.state == CHUNK_END:
+            if line:
                 raise ParseError("Chunk is missing the \\r\\n terminator.")
-            (size, rest) = self.parse_chunk_size(unreader, data=rest[2:]) 
+            self.state = CHUNK_SIZE
+            return
+        chunk_size = line.split(b(";"), 1)[0].rstrip(b(" \t"))
+        if CHUNK_SIZE_RE.match(chunk_size) is None:
+            raise ParseError("Invalid chunk size: %r" % chunk_size)
+        self.remaining = int(chunk_size, 16)
+        if self.remaining:
+            self.state = CHUNK_DATA
+        else:
+            self.state = CHUNK_TRAILERS
+            self.trailer_parser = RequestParser(headers_only=True)
 
-    def parse_chunk_size(self, unreader, data=None):
-        buf = BufferIO()
-        if data is not None:
-            buf.write(data)
+    def read_line(self):
+        while True:
+            data = self.unreader.peek()
+            if not len(data):
+                raise ParseError("Client disconnected while reading chunked body.")
+            match = LINE_END_RE.search(data)
+            end = match is not None and match.end() or len(data)
+            self.line += data[:end]
+            del data
+            self.unreader.consume(end)
+            if len(self.line) > self.max_line:
+                raise ParseError("Chunk size line too long.")
+            if match is not None:
+                line = bytes(self.line).rstrip(b("\r\n"))
+                del self.line[:]
+                return line
 
-        idx = buf.getvalue().find("\r\n")
-        while idx < 0:
-            self.get_data(unreader, buf)
-            idx = buf.getvalue().find("\r\n")
+    def parse_trailers(self):
+        parser = self.trailer_parser
+        while parser.next_event() is NEED_DATA:
+            data = self.unreader.peek()
+            if not len(data):
+                if parser.started:
+                    raise ParseError("Client disconnected while reading trailers.")
+                # Tolerate clients that close without the final CRLF.
+                break
+            used = parser.feed(data)
+            del data
+            self.unreader.consume(used)
+        self.state = CHUNK_DONE
+        self.trailer_parser = None
+        if parser.headers:
+            self.req.trailers = parser.headers
+            if self.trailer_handler is not None:
+                self.trailer_handler(parser.headers)
 
-        data = buf.getvalue()
-        line, rest_chunk = data[:idx], data[idx+2:]
-    
-        chunk_size = line.split(";", 1)[0].strip()
-        try:
-            chunk_size = int(chunk_size, 16)
-        except ValueError:
-            raise ParseError("Invalid chunk size: %r" % chunk_size)
 
-        if chunk_size == 0:
+class Spool(object):
+    """\
+    Append only storage for a spooled request body. Bytes are
+    kept in memory up to threshold and then moved to a memory
+    mapped temporary file, sized from size_hint when the body
+    length is known and doubled as needed otherwise.
+    """
+    __slots__ = ("threshold", "size_hint", "size", "buf", "file", "map")
+
+    def __init__(self, threshold=SPOOL_SIZE, size_hint=None):
+        self.threshold = threshold
+        self.size_hint = size_hint
+        self.size = 0
+        self.buf = bytearray()
+        self.file = None
+        self.map = None
+
+    def write(self, data):
+        end = self.size + len(data)
+        if self.map is None and end > self.threshold:
+            self.spill(end)
+        if self.map is not None:
+            if end > len(self.map):
+                self.remap(max(end, len(self.map) * 2))
+            self.map[self.size:end] = data
+        else:
+            self.buf += data
+        self.size = end
+
+    def readinto(self, pos, buf):
+        view = memoryview(buf)
+        count = max(min(len(view), self.size - pos), 0)
+        if self.map is not None:
+            data = memoryview(self.map)
+            view[:count] = data[pos:pos + count]
+            del data
+        else:
+            view[:count] = self.buf[pos:pos + count]
+        return count
+
+    def spill(self, end):
+        self.file = tempfile.TemporaryFile()
+        self.remap(max(end, self.size_hint or 0, self.threshold * 2))
+        self.map[:self.size] = bytes(self.buf)
+        self.buf = None
+
+    def remap(self, capacity):
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(capacity)
+        self.map = mmap.mmap(self.file.fileno(), capacity)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = self.file = None
+        self.buf = None
+
+
+class SpoolReader(object):
+    """\
+    Wraps a LengthReader or ChunkedReader and keeps everything
+    it returns in a Spool. Reads made after seeking back are
+    served from the spool and reads past its end go on to the
+    wrapped reader.
+    """
+    __slots__ = ("reader", "unreader", "spool", "pos")
+
+    def __init__(self, reader, threshold=SPOOL_SIZE):
+        self.reader = reader
+        self.unreader = reader.unreader
+        self.spool = Spool(threshold, getattr(reader, "length", None))
+        self.pos = 0
+
+    def set_trailer_handler(self, func):
+        self.reader.set_trailer_handler(func)
+
+    def read(self, size):
+        buf = bytearray(min(size, MAX_READ))
+        count = self.readinto(buf)
+        del buf[count:]
+        return bytes(buf)
+
+    def readinto(self, buf):
+        view = memoryview(buf)
+        if self.pos < self.spool.size:
+            count = self.spool.readinto(self.pos, view)
+        else:
+            count = self.reader.readinto(view)
+            self.spool.write(view[:count])
+        self.pos += count
+        return count
+
+    def drain(self, until=sys.maxsize):
+        # Read from the wrapped reader until the spool holds
+        # until bytes or the body has ended.
+        scratch = bytearray(READ_SIZE * 8)
+        self.pos = self.spool.size
+        while self.spool.size < until and self.readinto(scratch):
+            pass
+
+    def close(self):
+        self.spool.close()
+
+
+class InflateReader(object):
+    """\
+    Wraps a LengthReader or ChunkedReader whose body has a gzip
+    or deflate Content-Encoding and returns the decompressed
+    bytes. Output is produced at most READ_SIZE * 8 bytes at a
+    time and BodyTooLarge is raised as soon as more than limit
+    bytes have come out, so a small compressed body can't
+    expand into an unbounded amount of memory.
+    """
+    __slots__ = ("reader", "unreader", "wbits", "limit", "size",
+                    "inflater", "pending")
+
+    def __init__(self, reader, coding, limit):
+        self.reader = reader
+        self.unreader = reader.unreader
+        self.wbits = INFLATE_WBITS[coding]
+        self.limit = limit
+        self.size = 0
+        self.inflater = None
+        self.pending = memoryview(b(""))
+
+    def set_trailer_handler(self, func):
+        self.reader.set_trailer_handler(func)
+
+    def read(self, size):
+        buf = bytearray(min(size, MAX_READ))
+        count = self.readinto(buf)
+        del buf[count:]
+        return bytes(buf)
+
+    def readinto(self, buf):
+        view = memoryview(buf)
+        if not len(self.pending):
+            self.pending = memoryview(self.inflate())
+        count = min(len(view), len(self.pending))
+        view[:count] = self.pending[:count]
+        self.pending = self.pending[count:]
+        return count
+
+    def inflate(self):
+        # Returns an empty string only at the end of the body.
+        while True:
+            data = self.inflater is not None and self.inflater.unconsumed_tail
+            if not data:
+                data = self.reader.read(READ_SIZE * 8)
+                if not data:
+                    return self.finish()
+            if self.inflater is None:
+                self.start(data)
             try:
-                self.parse_trailers(unreader, rest_chunk)
-            except NoMoreData:
-                pass
-            return (0, None)
-        return (chunk_size, rest_chunk)
+                out = self.inflater.decompress(data, READ_SIZE * 8)
+            except zlib.error as e:
+                raise ParseError("Invalid compressed body: %s" % e)
+            if out:
+                self.size += len(out)
+                if self.size > self.limit:
+                    raise BodyTooLarge("Decompressed body too large.")
+                return out
 
-    def get_data(self, unreader, buf):
-        data = unreader.read()
-        if not data:
-            raise ParseError("Client disconnected while reading chunked body.")
-            raise NoMoreData()
-        buf.write(data)
+    def start(self, data):
+        wbits = self.wbits
+        head = bytearray(data[:2])
+        if wbits == zlib.MAX_WBITS and len(head) == 2:
+            # Plenty of clients send raw deflate data without the
+            # zlib header that the coding calls for.
+            if (head[0] & 0x0f) != 8 or ((head[0] << 8) | head[1]) % 31:
+                wbits = -zlib.MAX_WBITS
+        self.inflater = zlib.decompressobj(wbits)
+
+    def finish(self):
+        if self.inflater is None:
+            return b("")
+        if not getattr(self.inflater, "eof", True):
+            raise ParseError("Compressed body ended early.")
+        return self.inflater.flush()
 
 
 class Body(object):
     """\
     This class implements the necessary methods specified by
     WSGI v1.0.
+
+    Reads are sized from what the caller asked for and what is
+    already buffered, between READ_SIZE and MAX_READ, instead
+    of a fixed small block. read(size) and readinto() have the
+    reader decode straight into the returned buffer.
+
+    Iterating splits a whole block into lines at once and hands
+    them out one at a time. Those lines are kept in reverse
+    order in lines and always come before the bytes in buf.
+
+    Calling spool() makes the body seekable. Everything read
+    from then on is kept, so seek() can rewind the body and
+    read it again without going back to the socket.
     """
+    __slots__ = ("reader", "buf", "lines", "pre_read")
+
     def __init__(self, reader):
+        self.buf = bytearray()
+        self.lines = []
+        self.reset(reader)
+
+    def reset(self, reader):
+        if type(getattr(self, "reader", None)) is SpoolReader:
+            self.reader.close()
         self.reader = reader
-        self.buf = BufferIO()
+        del self.buf[:]
+        del self.lines[:]
         self.pre_read = None
     
     def set_pre_read(self, func):
@@ -238,16 +619,20 @@ class Body(object):
         self.pre_read = func
 
     def set_trailers_handler(self, func):
-        self.reader.set_trailers_handler(func)
+        self.reader.set_trailer_handler(func)
 
     def __iter__(self):
         return self
     
-    def next(self):
-        ret = self.readline()
-        if not ret:
-            raise StopIteration()
-        return ret
+    def __next__(self):
+        lines = self.lines
+        if not lines:
+            self._split()
+            if not lines:
+                raise StopIteration()
+        return lines.pop()
+
+    next = __next__
 
     def discard(self):
         """\
@@ -255,81 +640,175 @@ class Body(object):
         body data we need to discard anything before processing
         the nest request.
         """
-        data = self.read(8192)
-        while data:
-            data = self.read(8192)
+        del self.buf[:]
+        del self.lines[:]
+        self.unwrap()
+        scratch = bytearray(self._read_size(READ_SIZE * 8))
+        while self._readinto(scratch):
+            pass
     
+    def unwrap(self):
+        """\
+        Stop spooling and decompressing so the rest of the body
+        is read as it was sent, which is all discarding needs.
+        """
+        if type(self.reader) is SpoolReader:
+            self.reader.close()
+            self.reader = self.reader.reader
+        if type(self.reader) is InflateReader:
+            self.reader = self.reader.reader
+
+    def spool(self, threshold=SPOOL_SIZE):
+        """\
+        Keep the rest of the body so that it can be read again.
+        Up to threshold bytes are held in memory, larger bodies
+        are stored in a memory mapped temporary file. The
+        current position becomes offset zero.
+        """
+        if type(self.reader) is SpoolReader:
+            return
+        if self.lines:
+            self._unsplit()
+        reader = SpoolReader(self.reader, threshold)
+        reader.spool.write(self.buf)
+        del self.buf[:]
+        self.reader = reader
+
+    def seekable(self):
+        return type(self.reader) is SpoolReader
+
+    def tell(self):
+        if not self.seekable():
+            raise IOError("Body is not seekable, call spool() first.")
+        pending = len(self.buf) + sum(len(line) for line in self.lines)
+        return self.reader.pos - pending
+
+    def seek(self, offset, whence=0):
+        if not self.seekable():
+            raise IOError("Body is not seekable, call spool() first.")
+        reader = self.reader
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2:
+            reader.drain()
+            offset += reader.spool.size
+        elif whence != 0:
+            raise ValueError("Invalid whence: %r" % whence)
+        if offset < 0:
+            raise ValueError("Negative seek position: %r" % offset)
+        if offset > reader.spool.size:
+            reader.drain(offset)
+        del self.buf[:]
+        del self.lines[:]
+        reader.pos = min(offset, reader.spool.size)
+        return reader.pos
+
     def read(self, size=None):
         size = self._get_size(size)
         if size == 0:
-            return ""
-
-        if size < self.buf.tell():
-            data = self.buf.getvalue()
-            ret, rest = data[:size], data[size:]
-            self.buf.truncate(0)
-            self.buf.seek(0)
-            self.buf.write(rest)
+            return b("")
+        if self.lines:
+            self._unsplit()
+
+        buf = self.buf
+        if size <= len(buf):
+            ret = bytes(buf[:size])
+            del buf[:size]
             return ret
 
-        while size > self.buf.tell():
-            data = self._get_data()
-            if not len(data):
-                break
-            self.buf.write(data)
+        if size == sys.maxsize and type(self.reader) is LengthReader:
+            size = len(buf) + self.reader.length
+        if size == sys.maxsize:
+            chunks = [bytes(buf)]
+            del buf[:]
+            chunk_size = READ_SIZE
+            data = self._get_data(chunk_size)
+            while len(data):
+                chunks.append(data)
+                chunk_size = min(chunk_size * 2, MAX_READ)
+                data = self._get_data(chunk_size)
+            return b("").join(chunks)
 
-        data = self.buf.getvalue()
-        ret, rest = data[:size], data[size:]
-        self.buf.truncate(0)
-        self.buf.seek(0)
-        self.buf.write(rest)
-        return ret
+        # The size may come straight from the client's headers, so
+        # only allocate what one large read can fill and grow the
+        # result as data actually arrives.
+        ret = bytearray(min(size, len(buf) + MAX_READ))
+        pos = self.readinto(ret)
+        while pos == len(ret) and pos < size:
+            ret.extend(bytearray(min(size - pos, pos)))
+            pos += self.readinto(memoryview(ret)[pos:])
+        del ret[pos:]
+        return bytes(ret)
+
+    def readinto(self, buf):
+        """\
+        Fill buf with body data without an intermediate copy and
+        return the number of bytes written. Fewer than len(buf)
+        bytes are only returned at the end of the body.
+        """
+        if self.lines:
+            self._unsplit()
+        view = memoryview(buf)
+        size = len(view)
+        pos = min(size, len(self.buf))
+        if pos:
+            view[:pos] = self.buf[:pos]
+            del self.buf[:pos]
+        while pos < size:
+            count = self._readinto(view[pos:])
+            if not count:
+                break
+            pos += count
+        return pos
     
     def readline(self, size=None):
         size = self._get_size(size)
         if size == 0:
-            return ""
-        
-        idx = self.buf.getvalue().find("\n")
-        while idx < 0:
-            data = self._get_data(1024)
-            if not len(data):
-                break
-            self.buf.write(data)
-            idx = self.buf.getvalue().find("\n")
-            if size < self.buf.tell():
+            return b("")
+        if self.lines:
+            self._unsplit()
+
+        # Only scan the bytes each fill adds, not the whole buffer.
+        buf = self.buf
+        scanned = 0
+        idx = buf.find(b("\n"), 0, size)
+        while idx < 0 and len(buf) < size:
+            scanned = len(buf)
+            if not self._fill(min(size - scanned, READ_SIZE * 8)):
                 break
-        
-        # If we didn't find it, and we got here, we've
-        # exceeded size or run out of data.
+            idx = buf.find(b("\n"), scanned, size)
+
         if idx < 0:
-            rlen = min(size, self.buf.tell())
+            rlen = min(size, len(buf))
         else:
             rlen = idx + 1
-
-            # If rlen is beyond our size threshold, trim back
-            if rlen > size:
-                rlen = size
-        
-        data = self.buf.getvalue()
-        ret, rest = data[:rlen], data[rlen:]
-        
-        self.buf.truncate(0)
-        self.buf.seek(0)
-        self.buf.write(rest)
+        ret = bytes(buf[:rlen])
+        del buf[:rlen]
         return ret
-    
-    def readlines(self, size=None):
-        ret = []
-        data = self.read()
-        while len(data):
-            pos = data.find("\n")
-            if pos < 0:
-                ret.append(data)
-                data = ""
-            else:
-                line, data = data[:pos+1], data[pos+1:]
+
+    def readlines(self, hint=None):
+        """\
+        Return a list of lines. With a positive hint, stop once
+        the lines add up to at least hint bytes so a large body
+        can be processed a batch at a time.
+        """
+        hint = self._get_size(hint) or sys.maxsize
+        ret, total = [], 0
+        lines = self.lines
+        while total < hint:
+            if not lines:
+                self._split()
+                if not lines:
+                    break
+            if hint == sys.maxsize:
+                lines.reverse()
+                ret.extend(lines)
+                del lines[:]
+                continue
+            while lines and total < hint:
+                line = lines.pop()
                 ret.append(line)
+                total += len(line)
         return ret
 
     def _get_size(self, size):
@@ -338,77 +817,200 @@ class Body(object):
         attempts to mimic the behaviour of a file object.
         """
         if size is None:
-            return sys.maxint
-        elif not isinstance(size, (int, long)):
+            return sys.maxsize
+        elif not isinstance(size, INT_TYPES):
             raise TypeError("Size must be an integral type")
         elif size < 0:
-            return sys.maxint
+            return sys.maxsize
         return size
 
-    def _get_data(self):
+    def _split(self):
+        """\
+        Read until the buffer holds at least one complete line
+        or the body ends, then split off every complete line.
+        """
+        buf = self.buf
+        scanned = 0
+        idx = buf.rfind(b("\n"))
+        while idx < 0:
+            scanned = len(buf)
+            if not self._fill(READ_SIZE * 8):
+                if buf:
+                    self.lines.append(bytes(buf))
+                    del buf[:]
+                return
+            idx = buf.rfind(b("\n"), scanned)
+        block = bytes(buf[:idx + 1])
+        del buf[:idx + 1]
+        if b("\r") in block:
+            # splitlines would also break on a lone \r.
+            lines, pos = [], 0
+            while pos < len(block):
+                end = block.index(b("\n"), pos) + 1
+                lines.append(block[pos:end])
+                pos = end
+        else:
+            lines = block.splitlines(True)
+        lines.reverse()
+        self.lines.extend(lines)
+
+    def _unsplit(self):
+        self.lines.reverse()
+        self.buf[:0] = b("").join(self.lines)
+        del self.lines[:]
+
+    def _read_size(self, size):
+        # Take at least whatever the connection already has
+        # buffered, it costs no system call.
+        size = max(size, len(self.reader.unreader), READ_SIZE)
+        return min(size, MAX_READ)
+
+    def _get_data(self, size=READ_SIZE):
         if self.pre_read is not None:
             self.pre_read()
             self.pre_read = None
-        return self.reader.read(1024)
+        return self.reader.read(self._read_size(size))
 
-class Request(object):
-    def __init__(self, unreader):
-        self.unreader = unreader
+    def _readinto(self, view):
+        if self.pre_read is not None:
+            self.pre_read()
+            self.pre_read = None
+        return self.reader.readinto(view)
 
-        self.methre = re.compile(b("[A-Z0-9$-_.]{3,20}"))
-        self.versre = re.compile(b("HTTP/(\d+).(\d+)"))
-        self.hdrre = re.compile(b("[\x00-\x1F\x7F()<>@,;:\[\]={} \t\\\\\"]"))
+    def _fill(self, size=READ_SIZE):
+        """\
+        Append up to size bytes from the reader to the buffer
+        without waiting for more than one receive. Returns the
+        number of bytes added.
+        """
+        size = self._read_size(size)
+        if type(self.reader) is LengthReader:
+            size = min(size, self.reader.length)
+        if size <= 0:
+            return 0
+        chunk = bytearray(size)
+        count = self._readinto(chunk)
+        self.buf += memoryview(chunk)[:count]
+        return count
+
+
+def header_name(name):
+    key = NAMES.get(name)
+    if key is None:
+        key = name.lower()
+        if len(NAMES) < MAX_NAMES:
+            key = NAMES.setdefault(key, key)
+            NAMES[name] = key
+    return key
 
+
+class Headers(dict):
+    """\
+    Request headers as a dict mapping lower case names to the
+    list of values sent for each, which is the form used for
+    http.headers in the environ. The (name, value) pairs are
+    also kept in fields in the order they were received,
+    duplicates included.
+    """
+    def __init__(self):
+        super(Headers, self).__init__()
+        self.fields = []
+
+    def add(self, name, value):
+        name = header_name(name)
+        self.fields.append((name, value))
+        values = self.get(name)
+        if values is None:
+            self[name] = [value]
+        else:
+            values.append(value)
+
+    def remove(self, name):
+        if self.pop(name, None) is not None:
+            self.fields = [f for f in self.fields if f[0] != name]
+
+    def last(self, name, default=None):
+        values = self.get(name)
+        if values is None:
+            return default
+        return values[-1]
+
+
+class RequestParser(object):
+    """\
+    An incremental parser for request heads. Bytes are pushed
+    in with feed() as they arrive and parsing resumes where the
+    previous call stopped, so every byte is scanned only once
+    no matter how slowly the head trickles in. next_event()
+    reports NEED_DATA until a complete head has been seen and
+    REQUEST afterwards.
+    """
+    def __init__(self, max_line=8190, max_headers=100, headers_only=False):
+        self.max_line = max_line
+        self.max_headers = max_headers
+        self.headers_only = headers_only
+        self.reset()
+
+    def reset(self):
+        self.state = self.headers_only and HEADERS or REQUEST_LINE
+        self.partial = bytearray()
+        self.started = False
         self.method = None
         self.uri = None
-        self.scheme = None
-        self.userinfo = None
-        self.host = None
-        self.port = b("80")
-        self.path = None
-        self.query = None
-        self.fragment = None
         self.version = None
-        self.headers = []
-        self.trailers = []
-        self.body = None
+        self.headers = Headers()
+        self.name = None
+        self.value = None
 
-        unused = self.parse(self.unreader)
-        self.unreader.unread(unused)
-        self.set_body_reader()
-    
-    def parse(self, unreader):
-        buf = BufferIO()
+    def next_event(self):
+        if self.state == DONE:
+            return REQUEST
+        return NEED_DATA
 
-        self._get_data(unreader, buf, stop=True)
-        
-        # Request line
-        idx = buf.getvalue().find(b("\r\n"))
-        while idx < 0:
-            self._get_data(unreader, buf)
-            idx = buf.getvalue().find(b("\r\n"))
-        self.parse_request_line(buf.getvalue()[:idx])
-        rest = buf.getvalue()[idx+2:] # Skip \r\n
-        buf.truncate(0)
-        buf.seek(0)
-        buf.write(rest)
-        
-        # Headers
-        idx = buf.getvalue().find(b("\r\n\r\n"))
-        done = buf.getvalue()[:2] == b("\r\n")
-        while idx < 0 and not done:
-            self._get_data(unreader, buf)
-            idx = buf.getvalue().find(b("\r\n\r\n"))
-            done = buf.getvalue()[:2] == b("\r\n")
-        if done:
-            self.unreader.unread(buf.getvalue()[2:])
-            return b("")
-        self.headers = self.parse_headers(buf.getvalue()[:idx])
+    def feed(self, data):
+        """\
+        Parse as much of data as belongs to the request head.
+        Returns the number of bytes used. Anything following the
+        end of the head is left untouched for the caller.
+        """
+        pos, size = 0, len(data)
+        while pos < size and self.state != DONE:
+            self.started = True
+            match = LINE_END_RE.search(data, pos)
+            if match is None:
+                self.partial += data[pos:]
+                if len(self.partial) > self.max_line:
+                    raise ParseError("Line too long.")
+                return size
+            end = match.end()
+            if self.partial:
+                self.partial += data[pos:end]
+                line = bytes(self.partial)
+                self.partial = bytearray()
+            else:
+                line = bytes(data[pos:end])
+            if len(line) > self.max_line:
+                raise ParseError("Line too long.")
+            self.parse_line(line.rstrip(b("\r\n")))
+            pos = end
+        return pos
 
-        ret = buf.getvalue()[idx+4:]
-        buf.truncate(0)
-        buf.seek(0)
-        return ret
+    def parse_line(self, line):
+        if self.state == REQUEST_LINE:
+            # Tolerate stray empty lines between requests.
+            if line:
+                self.parse_request_line(line)
+                self.state = HEADERS
+        elif not line:
+            self.finish_header()
+            self.state = DONE
+        elif line[:1] in (b(" "), b("\t")):
+            if self.name is None:
+                raise ParseError("Invalid header. Continuation without header.")
+            self.value.append(line)
+        else:
+            self.finish_header()
+            self.parse_header(line)
 
     def parse_request_line(self, line):
         bits = line.split(None, 2)
@@ -416,104 +1018,171 @@ class Request(object):
             raise ParseError("Invalid request line.")
 
         # Method
-        if not self.methre.match(bits[0]):
+        if not METHOD_RE.match(bits[0]):
             raise ParseError("Invalid request line. Bad method.")
         self.method = bits[0].upper()
 
-        # URI
         self.uri = bits[1]
-        parts = uri.parse(bits[1])
-        self.scheme = parts["scheme"] or None
-        self.userinfo = parts["userinfo"] or None
-        self.host = parts["host"] or None
-        if not parts["port"]:
-            if self.scheme == b("http"):
-                self.port = b("80")
-            elif self.scheme == b("https"):
-                self.port = b("443")
-            else:
-                self.port = None
-        self.path = parts["path"] or None
-        self.query = parts["query"] or None
-        self.fragment = parts["fragment"] or None
 
         # Version
-        match = self.versre.match(bits[2])
+        match = VERSION_RE.match(bits[2])
         if match is None:
             raise ParseError("Invalid HTTP version.")
         self.version = (int(match.group(1)), int(match.group(2)))
 
-    def parse_headers(self, data):
-        headers = []
+    def parse_header(self, line):
+        if line.find(b(":")) < 0:
+            raise ParseError("Invalid header. No colon separator found.")
+        name, value = line.split(b(":"), 1)
+        name = name.rstrip(b(" \t"))
+        if HEADER_NAME_RE.search(name):
+            raise ParseError("Invalid header. Invalid bytes.")
+        if len(self.headers.fields) >= self.max_headers:
+            raise ParseError("Too many headers.")
+        self.name, self.value = name, [value.lstrip()]
 
-        # Split lines on \r\n keeping the \r\n on each line
-        lines = []
-        while len(data):
-            pos = data.find(b("\r\n"))
-            if pos < 0:
-                lines.append(data)
-                data = b("")
-            else:
-                lines.append(data[:pos+2])
-                data = data[pos+2:]
-
-        # Parse headers into key/value pairs paying attention
-        # to continuation lines.
-        while len(lines):
-            # Parse initial header name : value pair.
-            curr = lines.pop(0)
-            if curr.find(b(":")) < 0:
-                raise ParseError("Invalid header. No colon separator found.")
-            name, value = curr.split(b(":"), 1)
-            name = name.rstrip(b(" \t")).upper()
-            if self.hdrre.search(name):
-                raise ParseError("Invalid header. Invalid bytes.")
-            name, value = name.strip(), [value.lstrip()]
-            
-            # Consume value continuation lines
-            while len(lines) and lines[0].startswith((b(" "), b("\t"))):
-                value.append(lines.pop(0))
-            value = b("").join(value).rstrip()
-            
-            headers.append((name, value))
-        return headers
+    def finish_header(self):
+        if self.name is None:
+            return
+        value = b("\r\n").join(self.value).rstrip()
+        self.headers.add(self.name, value)
+        self.name, self.value = None, None
+
+
+class Request(object):
+    """\
+    A parsed request head and the body that follows it. The
+    request URI is validated while the head is parsed, which
+    the uri module's cache makes cheap, but the dict of its
+    parts is only built the first time one of them is read.
+
+    With a positive inflate_limit, gzip and deflate encoded
+    bodies are decompressed on the fly, up to that many bytes,
+    and the Content-Encoding and Content-Length headers that
+    described the encoded body are removed.
+
+    Once a request and its body are finished with, reset()
+    reads the next request on the connection into the same
+    objects instead of allocating new ones.
+    """
+    __slots__ = ("unreader", "method", "uri", "target", "parts", "version",
+                    "headers", "trailers", "body", "inflate_limit")
+
+    def __init__(self, unreader, parser=None, inflate_limit=0):
+        self.body = None
+        self.inflate_limit = inflate_limit
+        self.reset(unreader, parser)
+
+    def reset(self, unreader, parser=None):
+        self.unreader = unreader
+
+        self.method = None
+        self.uri = None
+        self.target = None
+        self.parts = None
+        self.version = None
+        self.headers = None
+        self.trailers = None
+
+        parser = self.parse(self.unreader, parser)
+        self.method = parser.method
+        self.version = parser.version
+        self.headers = parser.headers
+        self.parse_uri(parser.uri)
+        self.set_body_reader()
+
+    scheme = property(lambda self: self.uri_parts()["scheme"])
+    userinfo = property(lambda self: self.uri_parts()["userinfo"])
+    host = property(lambda self: self.uri_parts()["host"])
+    port = property(lambda self: self.uri_parts()["port"])
+    path = property(lambda self: self.uri_parts()["path"])
+    query = property(lambda self: self.uri_parts()["query"])
+    fragment = property(lambda self: self.uri_parts()["fragment"])
+
+    def parse(self, unreader, parser=None):
+        """\
+        Read until parser has seen a complete request head. A
+        parser that was already fed part of the head by the
+        caller picks up where it stopped.
+        """
+        if parser is None:
+            parser = RequestParser()
+        while parser.next_event() is NEED_DATA:
+            data = unreader.peek()
+            if not len(data):
+                if parser.started:
+                    raise ParseError("Client closed prematurely.")
+                raise NoMoreData()
+            unreader.consume(parser.feed(data))
+        return parser
+
+    def uri_parts(self):
+        if self.parts is None:
+            self.parts = self.make_parts(self.target)
+        return self.parts
+
+    def parse_uri(self, value):
+        self.uri = value
+        self.parts = None
+        try:
+            self.target = uri.lookup(value)
+        except ValueError:
+            raise ParseError("Invalid request URI.")
+
+    def make_parts(self, target):
+        parts = dict(target)
+        for key, val in parts.items():
+            parts[key] = val or None
+        if parts["port"] is None:
+            if parts["scheme"] == b("http"):
+                parts["port"] = b("80")
+            elif parts["scheme"] == b("https"):
+                parts["port"] = b("443")
+        return parts
 
     def set_body_reader(self):
-        chunked = False
-        clength = 0
-
-        for (name, value) in self.headers:
-            if name.lower() == b("content-length"):
-                try:
-                    clength = int(value)
-                except ValueError:
-                    clength = 0
-            elif name.lower() == b("transfer-encoding"):
-                chunked = value.lower() == b("chunked")
-            elif name.lower() == b("sec-websocket-key1"):
-                clength = 8
-
-        if chunked:
-            self.body = Body(ChunkedReader(self.unreader, self))
+        headers = self.headers
+        if b("sec-websocket-key1") in headers:
+            clength = 8
         else:
-            self.body = Body(LengthReader(self.unreader, clength))
-
-    def should_close(self):
-        for (h, v) in self.headers:
-            if h.lower() == b("connection"):
-                if v.lower().strip() == b("close"):
-                    return True
-                elif v.lower().strip() == b("keep-alive"):
-                    return False
-        return self.version <= (1, 0)
+            try:
+                clength = int(headers.last(b("content-length"), 0))
+            except ValueError:
+                clength = 0
+        te = headers.last(b("transfer-encoding"))
 
-    def _get_data(self, unreader, buf, stop=False):
-        data = unreader.read()
-        if not data:
-            if stop:
-                raise StopIteration()
-            raise ParseError("Client closed prematurely.")
-        buf.write(data)
+        # Reuse the previous request's reader when it is of the
+        # right type.
+        body = self.body
+        reader = body is not None and body.reader or None
+        if te is not None and te.lower() == b("chunked"):
+            if type(reader) is ChunkedReader:
+                reader.reset(self.unreader, self)
+            else:
+                reader = ChunkedReader(self.unreader, self)
+        elif type(reader) is LengthReader:
+            reader.reset(self.unreader, clength)
+        else:
+            reader = LengthReader(self.unreader, clength)
 
+        coding = headers.last(b("content-encoding"))
+        if self.inflate_limit > 0 and coding is not None:
+            coding = coding.strip().lower()
+            if coding in INFLATE_WBITS:
+                reader = InflateReader(reader, coding, self.inflate_limit)
+                headers.remove(b("content-encoding"))
+                headers.remove(b("content-length"))
 
+        if body is None:
+            self.body = Body(reader)
+        else:
+            body.reset(reader)
 
+    def should_close(self):
+        for v in self.headers.get(b("connection"), ()):
+            v = v.lower().strip()
+            if v == b("close"):
+                return True
+            elif v == b("keep-alive"):
+                return False
+        return self.version <= (1, 0)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+#
+# A streaming parser for multipart/form-data request bodies. The body
+# is read a block at a time and each part is copied into a spooled
+# temporary file that moves to disk once it grows past a threshold,
+# so an upload never has to fit in memory.
+
+import re
+import tempfile
+
+import wsgiref2.http as http
+
+from wsgiref2.util import b
+
+# Parts up to this size stay in memory.
+SPOOL_SIZE = 64 * 1024
+BLOCK_SIZE = 64 * 1024
+MAX_PARTS = 1000
+MAX_BOUNDARY = 200
+
+PARAM_RE = re.compile(b(r';\s*([^\s=;]+)\s*=\s*("(?:\\.|[^"\\])*"|[^;]*)'))
+QUOTED_RE = re.compile(b(r'\\(.)'))
+
+
+def parse_params(value):
+    """\
+    Split the parameters off a header value such as
+    Content-Type or Content-Disposition. Returns the value
+    without them and a dict of lower case names to values.
+    """
+    params = {}
+    for match in PARAM_RE.finditer(value):
+        pval = match.group(2).strip()
+        if pval[:1] == b('"'):
+            pval = QUOTED_RE.sub(b(r"\1"), pval[1:-1])
+        params[match.group(1).lower()] = pval
+    return value.split(b(";"), 1)[0].strip(), params
+
+
+def get_boundary(content_type):
+    """\
+    Return the boundary of a multipart Content-Type value or
+    None if the value doesn't describe a multipart body.
+    """
+    if content_type is None:
+        return None
+    ctype, params = parse_params(content_type)
+    if not ctype.lower().startswith(b("multipart/")):
+        return None
+    boundary = params.get(b("boundary"))
+    if not boundary:
+        raise http.ParseError("Multipart body without a boundary.")
+    if len(boundary) > MAX_BOUNDARY:
+        raise http.ParseError("Multipart boundary too long.")
+    return boundary
+
+
+def parse(environ, **kwargs):
+    """\
+    Return a MultipartParser for the request body described by
+    environ. Keyword arguments are passed to MultipartParser.
+    """
+    ctype = environ["http.headers"].last(b("content-type"))
+    boundary = get_boundary(ctype)
+    if boundary is None:
+        raise http.ParseError("Not a multipart request body.")
+    return MultipartParser(environ["http.body"], boundary, **kwargs)
+
+
+class Part(object):
+    """\
+    One part of a multipart body. Its data is stored in a
+    SpooledTemporaryFile that stays in memory up to spool_size
+    bytes, and the part can be read like a file. Closing it
+    removes any temporary file.
+    """
+    def __init__(self, headers, spool_size=SPOOL_SIZE):
+        self.headers = headers
+        self.spool_size = spool_size
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.size = 0
+
+        disposition = headers.last(b("content-disposition"), b(""))
+        params = parse_params(disposition)[1]
+        self.name = params.get(b("name"))
+        self.filename = params.get(b("filename"))
+        self.content_type = headers.last(b("content-type"))
+
+    @property
+    def in_memory(self):
+        return self.size <= self.spool_size
+
+    @property
+    def value(self):
+        """\
+        The whole content of the part. Meant for form fields,
+        which are small, rather than uploaded files.
+        """
+        pos = self.file.tell()
+        self.file.seek(0)
+        try:
+            return self.file.read()
+        finally:
+            self.file.seek(pos)
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        return self.file.readline(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __iter__(self):
+        return iter(self.file)
+
+
+class MultipartParser(object):
+    """\
+    Iterates over the parts of a multipart body read from an
+    http.Body. Boundaries are found with bytes.find over a
+    buffer holding one block plus enough of the previous one
+    to catch a delimiter split between reads, so memory use is
+    bounded by block_size no matter how large the parts are.
+    Each part is complete and rewound when it is yielded.
+    """
+    def __init__(self, body, boundary, spool_size=SPOOL_SIZE,
+                    block_size=BLOCK_SIZE, max_parts=MAX_PARTS):
+        self.body = body
+        self.boundary = boundary
+        self.spool_size = spool_size
+        self.block_size = block_size
+        self.max_parts = max_parts
+        # The leading CRLF lets the first delimiter be found the
+        # same way as the others.
+        self.buf = bytearray(b("\r\n"))
+
+    def __iter__(self):
+        delim = b("\r\n--") + self.boundary
+        self.find(delim)
+        count = 0
+        while True:
+            self.require(2)
+            if self.buf[:2] == b("--"):
+                return
+            self.skip_padding()
+            count += 1
+            if count > self.max_parts:
+                raise http.ParseError("Too many parts.")
+            part = Part(self.read_headers(), self.spool_size)
+            try:
+                self.find(delim, part.write)
+            except:
+                part.close()
+                raise
+            part.seek(0)
+            yield part
+
+    def fill(self):
+        data = self.body.read(self.block_size)
+        if not data:
+            return False
+        self.buf += data
+        return True
+
+    def require(self, size):
+        while len(self.buf) < size:
+            if not self.fill():
+                raise http.ParseError("Unexpected end of multipart body.")
+
+    def find(self, delim, sink=None):
+        """\
+        Consume bytes up to and including the next delimiter,
+        passing those before it to sink.
+        """
+        buf = self.buf
+        keep = len(delim) - 1
+        while True:
+            idx = buf.find(delim)
+            if idx >= 0:
+                if sink is not None and idx:
+                    sink(buf[:idx])
+                del buf[:idx + len(delim)]
+                return
+            if len(buf) > keep:
+                if sink is not None:
+                    sink(buf[:-keep])
+                del buf[:-keep]
+            if not self.fill():
+                raise http.ParseError("Unexpected end of multipart body.")
+
+    def skip_padding(self):
+        # Whitespace is allowed between a delimiter and its CRLF.
+        idx = self.buf.find(b("\r\n"))
+        while idx < 0:
+            if len(self.buf) > 1024:
+                raise http.ParseError("Invalid multipart delimiter line.")
+            self.require(len(self.buf) + 1)
+            idx = self.buf.find(b("\r\n"))
+        if self.buf[:idx].strip(b(" \t")):
+            raise http.ParseError("Invalid multipart delimiter line.")
+        del self.buf[:idx + 2]
+
+    def read_headers(self):
+        parser = http.RequestParser(headers_only=True)
+        while parser.next_event() is http.NEED_DATA:
+            if not self.buf:
+                self.require(1)
+            used = parser.feed(self.buf)
+            del self.buf[:used]
+        return parser.headers
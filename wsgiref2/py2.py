@@ -1,8 +1,17 @@
 
+import io
+
 try:
     from cStringIO import StringIO as BufferIO
 except ImportError:
     from StringIO import StringIO as BufferIO
 
+from urllib import unquote
+
+INT_TYPES = (int, long)
+
+# Plain binary files, whose fileno() gives the bytes they read.
+FILE_TYPES = (file, io.FileIO, io.BufferedReader)
+
 def b(value):
-    return value
\ No newline at end of file
+    return value
@@ -1,5 +1,13 @@
 
+import io
+
 from io import BytesIO as BufferIO
+from urllib.parse import unquote_to_bytes as unquote
+
+INT_TYPES = (int,)
+
+# Plain binary files, whose fileno() gives the bytes they read.
+FILE_TYPES = (io.FileIO, io.BufferedReader)
 
 def b(value):
     return value.encode("latin-1")
@@ -3,28 +3,108 @@
 # This file is part of wsgiref2 released under the MIT license. 
 # See the NOTICE for more information.
 
+import errno
 import optparse as op
+import os
 import pprint
+import signal
 import socket
+import threading
+import time
 import traceback
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
 import wsgiref2.http as http
 import wsgiref2.util as util
 import wsgiref2.wsgi as wsgi
 
-from wsgiref2.util import b
+from wsgiref2.util import b, STATUS_CODES
 
 __usage__ = "usage: %prog [OPTIONS]"
 
+BACKENDS = ("sync", "reactor", "asyncio")
+OVERFLOW_MODES = ("block", "reject")
+
+REJECT_RESPONSE = b("\r\n").join([
+    b("HTTP/1.1 503 %s" % STATUS_CODES[503]),
+    b("Content-Length: 0"),
+    b("Connection: close"),
+    b(""),
+    b("")
+])
+
+# Longest a connection closed with request data still unread is
+# drained for, and the most that is read from it, so the client
+# gets to read the response instead of a reset.
+LINGER_TIME = 2.0
+LINGER_SIZE = 256 * 1024
+
+# Rejections are drained on the accepting thread, so only briefly.
+REJECT_LINGER_TIME = 0.25
+
+def linger(sock, timeout=LINGER_TIME):
+    """\
+    Half-close sock and read and drop whatever the client still
+    sends until it closes its end, timeout seconds have passed
+    or LINGER_SIZE bytes were read. Closing a socket with unread
+    data makes the kernel reset the connection, which can lose
+    a response the client hasn't read yet.
+    """
+    try:
+        sock.shutdown(socket.SHUT_WR)
+        deadline = time.time() + timeout
+        size = 0
+        while size < LINGER_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            data = sock.recv(65536)
+            if not data:
+                break
+            size += len(data)
+    except socket.error:
+        pass
+
 class HTTPServer(object):
-    def __init__(self, address):
+    def __init__(self, address, workers=1, reuse_port=False, pin_cpus=False,
+                    coalesce_size=wsgi.COALESCE_SIZE, max_pipeline=16,
+                    inflate_limit=0):
         self.address = address
         self.backlog = 64
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.pin_cpus = pin_cpus
+        self.coalesce_size = coalesce_size
+        self.max_pipeline = max_pipeline
+        self.inflate_limit = inflate_limit
+        self.multithread = False
+        self.multiprocess = workers > 1
+        self.children = {}
+
+        # With SO_REUSEPORT every worker binds its own socket after
+        # the fork and the kernel balances connections between them.
+        self.sock = None
+        if not (self.multiprocess and self.reuse_port):
+            self.sock = self.listen()
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind(address)
-        self.sock.listen(self.backlog)
+    def listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.address)
+        sock.listen(self.backlog)
+        return sock
         
     def app(self, environ):
         status = 200
@@ -36,27 +116,408 @@ class HTTPServer(object):
         return status, headers, [body]
     
     def run(self):
+        if self.multiprocess:
+            self.supervise()
+        else:
+            self.serve()
+
+    def serve(self):
         while True:
             sock, addr = self.sock.accept()
-            try:
-                for req in self.requests(sock, addr):
-                    if not req.handle(self.app):
-                        break
-            except KeyboardInterrupt:
-                raise
-            except:
-                traceback.print_exc()
-            finally:
-                sock.close()
+            self.handle_connection(sock, addr)
+
+    def handle_connection(self, sock, addr):
+        try:
+            for req in self.requests(sock, addr):
+                if not req.handle(self.app):
+                    break
+        except KeyboardInterrupt:
+            raise
+        except:
+            traceback.print_exc()
+        finally:
+            sock.close()
+
+    def supervise(self):
+        """\
+        Fork the configured number of workers and replace any
+        of them that exit until the supervisor is interrupted
+        or terminated.
+        """
+        signal.signal(signal.SIGTERM, self.handle_term)
+        try:
+            for worker_id in range(self.workers):
+                self.spawn(worker_id)
+            while True:
+                pid, status = os.wait()
+                worker_id, started = self.children.pop(pid, (None, 0))
+                if worker_id is None:
+                    continue
+                # Don't spin if a worker dies as soon as it starts.
+                if time.time() - started < 1:
+                    time.sleep(1)
+                self.spawn(worker_id)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in list(self.children):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in list(self.children):
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            self.children.clear()
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (worker_id, time.time())
+            return
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if self.pin_cpus:
+                self.pin(worker_id)
+            if self.sock is None:
+                self.sock = self.listen()
+            self.serve()
+        except KeyboardInterrupt:
+            pass
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def pin(self, worker_id):
+        if not hasattr(os, "sched_setaffinity"):
+            return
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, [cpus[worker_id % len(cpus)]])
+
+    def handle_term(self, signum, frame):
+        raise KeyboardInterrupt()
 
     def requests(self, socket, address):
+        """\
+        Yield a wsgi.Request for each request on the connection.
+        Responses go through one writer per connection. It is only
+        flushed once no complete request head is left in the
+        buffer or max_pipeline responses are waiting, so pipelined
+        responses leave in a single write.
+
+        The parser and request objects are reused for every
+        request on the connection, so each wsgi.Request yielded
+        is only valid until the next one.
+        """
         unreader = http.Unreader(socket)
+        writer = wsgi.ResponseWriter(socket, self.coalesce_size)
+        parser = http.RequestParser()
+        httpreq = wsgireq = None
+        waiting = 0
+        try:
+            while True:
+                parser.reset()
+                if len(unreader):
+                    unreader.consume(parser.feed(unreader.peek()))
+                if parser.next_event() is http.NEED_DATA \
+                        or waiting >= self.max_pipeline:
+                    writer.flush()
+                    waiting = 0
+                try:
+                    if httpreq is None:
+                        httpreq = http.Request(unreader, parser,
+                                        self.inflate_limit)
+                    else:
+                        httpreq.reset(unreader, parser)
+                except http.NoMoreData:
+                    break
+                args = (self.address, address, socket, httpreq,
+                        self.multithread, self.multiprocess,
+                        self.coalesce_size, writer)
+                if wsgireq is None:
+                    wsgireq = wsgi.Request(*args)
+                else:
+                    wsgireq.reset(*args)
+                yield wsgireq
+                waiting += 1
+                if wsgireq.should_close():
+                    # The rest of the request isn't read, only drained.
+                    writer.flush()
+                    linger(socket)
+                    break
+                httpreq.body.discard()
+        finally:
+            try:
+                writer.flush()
+            finally:
+                unreader.close()
+
+class ThreadedHTTPServer(HTTPServer):
+    """\
+    Hands accepted connections to a fixed pool of worker
+    threads through a bounded queue so that one slow
+    application call doesn't stall every other client.
+    When the queue is full the accept loop either waits
+    for room or turns the client away with a 503.
+    """
+    def __init__(self, address, threads=8, queue_size=64, overflow="block",
+                    **kwargs):
+        if overflow not in OVERFLOW_MODES:
+            raise ValueError("Invalid overflow mode: %r" % overflow)
+        super(ThreadedHTTPServer, self).__init__(address, **kwargs)
+        self.threads = threads
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.multithread = True
+        self.queue = None
+
+    def serve(self):
+        self.start_workers()
+        super(ThreadedHTTPServer, self).serve()
+
+    def start_workers(self):
+        # Workers are started here rather than in __init__ so that
+        # each forked process gets its own pool.
+        self.queue = queue.Queue(self.queue_size)
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def handle_connection(self, sock, addr):
+        if not self.dispatch((sock, addr)):
+            self.reject(sock)
+
+    def dispatch(self, item):
+        if self.overflow == "block":
+            self.queue.put(item)
+            return True
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def reject(self, sock):
+        try:
+            sock.sendall(REJECT_RESPONSE)
+            linger(sock, REJECT_LINGER_TIME)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+    def work(self):
+        while True:
+            sock, addr = self.queue.get()
+            super(ThreadedHTTPServer, self).handle_connection(sock, addr)
+
+
+class Connection(object):
+    """\
+    A client connection owned by the reactor. It keeps the
+    Unreader and the partially fed RequestParser between
+    readiness events so the request head can be assembled
+    without blocking, and the request objects that are reused
+    for each request it carries.
+    """
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.unreader = http.Unreader(sock)
+        self.parser = http.RequestParser()
+        self.httpreq = None
+        self.wsgireq = None
+        self.active = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.unreader.close()
+        self.sock.close()
+
+
+class ReactorHTTPServer(ThreadedHTTPServer):
+    """\
+    A single reactor thread owns every client socket. It reads
+    and parses request heads without blocking and keeps idle
+    keep-alive connections parked in a selector. A connection
+    is only handed to a worker thread once a complete request
+    head has arrived, and it goes back to the reactor after the
+    response has been sent.
+    """
+    def __init__(self, address, keepalive=5, **kwargs):
+        super(ReactorHTTPServer, self).__init__(address, **kwargs)
+        self.keepalive = keepalive
+        self.selector = None
+        self.returned = None
+        self.waker = None
+        self.wakee = None
+        self.parked = {}
+
+    def serve(self):
+        self.start_workers()
+        self.selector = selectors.DefaultSelector()
+        self.returned = queue.Queue()
+        self.wakee, self.waker = socket.socketpair()
+        self.wakee.setblocking(False)
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.wakee, selectors.EVENT_READ, self.rearm)
+        expires = time.time() + 1
+        while True:
+            for key, events in self.selector.select(1):
+                key.data(key.fileobj)
+            if time.time() >= expires:
+                self.expire()
+                expires = time.time() + 1
+
+    def accept(self, listener):
+        try:
+            sock, addr = listener.accept()
+        except socket.error:
+            # Another worker process won the race for it.
+            return
+        sock.setblocking(False)
+        self.park(Connection(sock, addr))
+
+    def park(self, conn):
+        conn.active = time.time()
+        self.parked[conn.fileno()] = conn
+        self.selector.register(conn, selectors.EVENT_READ, self.readable)
+
+    def unpark(self, conn):
+        self.selector.unregister(conn)
+        del self.parked[conn.fileno()]
+
+    def readable(self, conn):
+        try:
+            if not conn.unreader.fill():
+                self.unpark(conn)
+                conn.close()
+                return
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.unpark(conn)
+            conn.close()
+            return
+        conn.active = time.time()
+        self.parse(conn)
+
+    def parse(self, conn):
+        try:
+            used = conn.parser.feed(conn.unreader.peek())
+            conn.unreader.consume(used)
+        except http.ParseError:
+            traceback.print_exc()
+            self.unpark(conn)
+            conn.close()
+            return
+        if conn.parser.next_event() is http.NEED_DATA:
+            return
+        self.start(conn)
+
+    def start(self, conn):
+        # Hand a connection with a complete request head to a worker.
+        self.unpark(conn)
+        conn.sock.setblocking(True)
+        if not self.dispatch(conn):
+            self.reject(conn.sock)
+            conn.unreader.close()
+
+    def rearm(self, wakee):
+        try:
+            wakee.recv(4096)
+        except socket.error:
+            pass
         while True:
-            httpreq = http.Request(unreader)
-            wsgireq = wsgi.Request(self.address, address, socket, httpreq)
-            yield wsgireq
-            if httpreq.should_close():
-                break        
+            try:
+                conn = self.returned.get_nowait()
+            except queue.Empty:
+                break
+            conn.sock.setblocking(False)
+            self.park(conn)
+            # A worker that hit max_pipeline may have parsed the head
+            # of the next request already, or left some of it buffered.
+            if conn.parser.next_event() is http.REQUEST:
+                self.start(conn)
+            elif len(conn.unreader):
+                self.parse(conn)
+
+    def expire(self):
+        limit = time.time() - self.keepalive
+        for conn in list(self.parked.values()):
+            if conn.active < limit:
+                self.unpark(conn)
+                conn.close()
+
+    def work(self):
+        while True:
+            conn = self.queue.get()
+            if self.process(conn):
+                self.returned.put(conn)
+                self.waker.send(b("x"))
+            else:
+                conn.close()
+
+    def process(self, conn):
+        """\
+        Serve the request that the reactor has parsed the head of,
+        followed by any complete requests pipelined behind it.
+        Returns True if the connection should go back to the
+        reactor to wait for another request.
+        """
+        writer = wsgi.ResponseWriter(conn.sock, self.coalesce_size)
+        closing = False
+        try:
+            for waiting in range(self.max_pipeline):
+                if conn.httpreq is None:
+                    conn.httpreq = http.Request(conn.unreader, conn.parser,
+                                        self.inflate_limit)
+                else:
+                    conn.httpreq.reset(conn.unreader, conn.parser)
+                conn.parser.reset()
+                httpreq = conn.httpreq
+                args = (self.address, conn.addr, conn.sock, httpreq, True,
+                        self.multiprocess, self.coalesce_size, writer)
+                if conn.wsgireq is None:
+                    conn.wsgireq = wsgi.Request(*args)
+                else:
+                    conn.wsgireq.reset(*args)
+                wsgireq = conn.wsgireq
+                if not wsgireq.handle(self.app):
+                    return False
+                if wsgireq.should_close():
+                    # The rest of the request isn't read, only drained.
+                    closing = True
+                    return False
+                httpreq.body.discard()
+                if not len(conn.unreader):
+                    return True
+                conn.unreader.consume(conn.parser.feed(conn.unreader.peek()))
+                if conn.parser.next_event() is http.NEED_DATA:
+                    return True
+            return True
+        except KeyboardInterrupt:
+            raise
+        except:
+            traceback.print_exc()
+            return False
+        finally:
+            try:
+                writer.flush()
+            except socket.error:
+                closing = False
+            if closing:
+                linger(conn.sock)
+
 
 def main():
     parser = op.OptionParser(usage=__usage__, option_list=options())
@@ -65,10 +526,47 @@ def main():
     if len(args) > 0:
         parser.error("Unrecognized arguments: %s" % ", ".join(args))
 
+    if opts.workers < 1:
+        parser.error("The number of workers must be at least 1.")
+    if opts.reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("SO_REUSEPORT is not supported on this platform.")
+    if opts.threads is not None and opts.threads < 1:
+        parser.error("The number of threads must be at least 1.")
+    if opts.queue_size < 1:
+        parser.error("The queue size must be at least 1.")
+    if opts.max_pipeline < 1:
+        parser.error("The pipeline limit must be at least 1.")
+    if opts.inflate_limit < 0:
+        parser.error("The inflate limit can't be negative.")
+
     address = (opts.ip, opts.port)
+    kwargs = {
+        "workers": opts.workers,
+        "reuse_port": opts.reuse_port,
+        "pin_cpus": opts.pin_cpus,
+        "coalesce_size": opts.coalesce_size,
+        "max_pipeline": opts.max_pipeline,
+        "inflate_limit": opts.inflate_limit
+    }
+    # Without -t each backend keeps its own default pool size.
+    if opts.threads is not None and opts.backend != "sync":
+        kwargs["threads"] = opts.threads
     
     try:
-        HTTPServer(address).run()
+        if opts.backend == "asyncio":
+            import wsgiref2.aio as aio
+            server = aio.AsyncHTTPServer(address, **kwargs)
+        elif opts.backend == "reactor":
+            server = ReactorHTTPServer(address, keepalive=opts.keepalive,
+                        queue_size=opts.queue_size, overflow=opts.overflow,
+                        **kwargs)
+        elif opts.threads is not None and opts.threads > 1:
+            server = ThreadedHTTPServer(address, threads=opts.threads,
+                        queue_size=opts.queue_size, overflow=opts.overflow,
+                        **kwargs)
+        else:
+            server = HTTPServer(address, **kwargs)
+        server.run()
     except KeyboardInterrupt:
         pass
     
@@ -78,6 +576,44 @@ def options():
             help="The ip address to bind to. [%default]"),
         op.make_option("-p", "--port", dest="port", type="int", default=8000,
             help="The port to serve from. [%default]"),
+        op.make_option("-b", "--backend", dest="backend", type="choice",
+            choices=BACKENDS, default="sync",
+            help="The I/O backend: sync, reactor or asyncio. [%default]"),
+        op.make_option("-w", "--workers", dest="workers", type="int",
+            default=1,
+            help="The number of worker processes to fork. [%default]"),
+        op.make_option("--reuse-port", dest="reuse_port", default=False,
+            action="store_true",
+            help="Give each worker its own SO_REUSEPORT socket instead of "
+                 "sharing one listening socket. [%default]"),
+        op.make_option("--pin-cpus", dest="pin_cpus", default=False,
+            action="store_true",
+            help="Pin each worker process to its own CPU. [%default]"),
+        op.make_option("-t", "--threads", dest="threads", type="int",
+            default=None,
+            help="The number of request threads per worker. The asyncio "
+                 "backend uses them to run the application. [1 for sync, "
+                 "8 otherwise]"),
+        op.make_option("--queue-size", dest="queue_size", type="int",
+            default=64,
+            help="Accepted connections waiting for a thread. [%default]"),
+        op.make_option("--overflow", dest="overflow", type="choice",
+            choices=OVERFLOW_MODES, default="block",
+            help="What to do when the queue is full: block or reject "
+                 "with a 503. [%default]"),
+        op.make_option("--coalesce-size", dest="coalesce_size", type="int",
+            default=wsgi.COALESCE_SIZE,
+            help="Response bytes to collect before writing. [%default]"),
+        op.make_option("--max-pipeline", dest="max_pipeline", type="int",
+            default=16,
+            help="Pipelined responses to hold before flushing. [%default]"),
+        op.make_option("--inflate-limit", dest="inflate_limit", type="int",
+            default=0,
+            help="Decompress gzip and deflate request bodies up to this "
+                 "many bytes, 0 turns it off. [%default]"),
+        op.make_option("--keepalive", dest="keepalive", type="int",
+            default=5,
+            help="Seconds the reactor keeps an idle connection. [%default]"),
     ]
 
 if __name__ == '__main__':
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+#
+# An application that serves the files below a directory. Open files
+# and their stat results are cached so a hit costs no system calls
+# until the cached stat goes stale, and file contents are never read
+# into Python objects: whole files and single ranges go out with
+# os.sendfile, and everything else is sliced out of a memory map.
+
+import binascii
+import email.utils
+import errno
+import mimetypes
+import mmap
+import os
+import re
+import stat
+import sys
+import threading
+import time
+
+import wsgiref2.wsgi as wsgi
+
+from wsgiref2.cache import etag_matches
+from wsgiref2.util import b, unquote, LRUCache, STATUS_CODES
+
+# Number of files kept open.
+MAX_FILES = 1024
+
+# Seconds a cached stat result is trusted before the file is checked
+# for changes again.
+STAT_TTL = 1.0
+
+# Requests for more ranges than this get the whole file.
+MAX_RANGES = 16
+
+BLOCK_SIZE = 65536
+
+DEFAULT_TYPE = b("application/octet-stream")
+
+OPEN_FLAGS = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0)
+
+RANGE_RE = re.compile(b(r"^(\d*)-(\d*)$"))
+
+
+def http_date(value):
+    return b(email.utils.formatdate(value, usegmt=True))
+
+
+def parse_date(value):
+    """\
+    Return the HTTP date value as seconds since the epoch or
+    None if it can't be parsed.
+    """
+    try:
+        parsed = email.utils.parsedate_tz(value.decode("latin-1"))
+        if parsed is None:
+            return None
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, TypeError, ValueError):
+        return None
+
+
+def parse_range(value, size):
+    """\
+    Parse a Range header value for a file of size bytes into a
+    sorted list of (start, end) pairs with overlapping ranges
+    merged and end exclusive. Returns None if the header
+    should be ignored and an empty list if no range can be
+    satisfied.
+    """
+    unit, sep, spec = value.partition(b("="))
+    if not sep or unit.strip().lower() != b("bytes"):
+        return None
+    ranges = []
+    for item in spec.split(b(",")):
+        item = item.strip()
+        if not item:
+            continue
+        match = RANGE_RE.match(item)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if not first:
+            if not last:
+                return None
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            end = size
+            if last:
+                if int(last) < start:
+                    return None
+                end = min(int(last) + 1, size)
+        if start < end:
+            ranges.append((start, end))
+        if len(ranges) > MAX_RANGES:
+            return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class File(object):
+    """\
+    An open file and the response headers that describe it.
+    The descriptor stays open for as long as anything refers
+    to the File, so a response can keep using it after the
+    File has been evicted from the cache.
+    """
+    def __init__(self, fd, st, ctype, checked):
+        self.fd = fd
+        self.ident = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.checked = checked
+        self.etag = b('"%x-%x"' % (int(st.st_mtime * 1000000), st.st_size))
+        self.last_modified = http_date(st.st_mtime)
+        self.ctype = ctype
+        self.map = None
+        self.lock = threading.Lock()
+
+    def __del__(self):
+        try:
+            os.close(self.fd)
+        except (AttributeError, OSError, TypeError):
+            pass
+
+    def fileno(self):
+        return self.fd
+
+    def same(self, st):
+        return self.ident == (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+    def view(self, end):
+        """\
+        Return a buffer over the file's memory map that holds at
+        least end bytes. The map is created on first use and
+        lives as long as the File or the buffers sliced from it.
+        """
+        if not end:
+            return b("")
+        with self.lock:
+            if self.map is None:
+                mapped = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+                try:
+                    self.map = memoryview(mapped)
+                except TypeError:
+                    self.map = mapped
+        if len(self.map) < end:
+            raise IOError("File ended before the response was sent.")
+        return self.map
+
+
+class FileBody(wsgi.FileWrapper):
+    """\
+    Sends length bytes of a File starting at offset. The
+    server uses os.sendfile, which doesn't move the file
+    position so responses can share a descriptor, and falls
+    back to iterating over slices of the File's memory map.
+    """
+    def __init__(self, f, offset, length, blksize=BLOCK_SIZE):
+        super(FileBody, self).__init__(f, blksize, offset, length)
+
+    def is_file(self):
+        # Files are only cached once fstat has shown they're regular.
+        return True
+
+    def __iter__(self):
+        end = self.offset + self.length
+        view = self.filelike.view(end)
+        for pos in range(self.offset, end, self.blksize):
+            yield view[pos:min(pos + self.blksize, end)]
+
+
+class RangesBody(object):
+    """\
+    A multipart/byteranges body. The ranges are sliced out of
+    the File's memory map between the part headers.
+    """
+    def __init__(self, f, parts, tail, blksize=BLOCK_SIZE):
+        self.file = f
+        self.parts = parts
+        self.tail = tail
+        self.blksize = blksize
+
+    def __iter__(self):
+        view = self.file.view(self.parts[-1][2])
+        for head, start, end in self.parts:
+            yield head
+            for pos in range(start, end, self.blksize):
+                yield view[pos:min(pos + self.blksize, end)]
+        yield self.tail
+
+
+class Static(object):
+    """\
+    Serves the files below root for GET and HEAD requests,
+    looked up by http.uri.path. Requests for a directory get
+    its index file, if any, and paths containing ".." or NUL
+    are refused.
+
+    Up to max_files files are kept open along with their
+    stat results and response headers. A cached file is
+    checked with os.stat once its result is older than ttl
+    seconds and reopened if it changed. Responses carry an
+    ETag and Last-Modified, are answered with a 304 when
+    If-None-Match or If-Modified-Since allow it and honour
+    Range and If-Range, with a multipart/byteranges body for
+    more than one range. max_age adds a Cache-Control header.
+    """
+    def __init__(self, root, index=b("index.html"), max_age=None,
+                    ttl=STAT_TTL, max_files=MAX_FILES, blksize=BLOCK_SIZE):
+        if not isinstance(root, bytes):
+            root = root.encode(sys.getfilesystemencoding())
+        self.root = os.path.abspath(root)
+        self.index = index
+        self.ttl = ttl
+        self.blksize = blksize
+        self.files = LRUCache(max_files)
+        self.cache_control = None
+        if max_age is not None:
+            self.cache_control = b("public, max-age=%d" % max_age)
+
+    def __call__(self, environ):
+        method = environ["http.method"]
+        if method not in (b("GET"), b("HEAD")):
+            return self.error(405, [(b("Allow"), b("GET, HEAD"))])
+
+        # An absolute-form target like http://host has no path.
+        urlpath = environ["http.uri.path"] or b("/")
+        path = self.resolve(urlpath)
+        if path is None:
+            return self.error(404)
+        if urlpath.endswith(b("/")):
+            if not self.index:
+                return self.error(404)
+            path = os.path.join(path, self.index)
+        f = self.lookup(path)
+        if f is None:
+            if self.index and os.path.isdir(path):
+                location = urlpath + b("/")
+                query = environ["http.uri.query_string"]
+                if query:
+                    location += b("?") + query
+                return self.error(301, [(b("Location"), location)])
+            return self.error(404)
+
+        headers = environ["http.headers"]
+        if self.not_modified(f, headers):
+            return 304, self.headers(f), []
+
+        ranges = None
+        value = headers.last(b("range"))
+        if value is not None and self.if_range(f, headers):
+            ranges = parse_range(value, f.size)
+        if ranges == []:
+            ret = self.error(416)
+            ret[1].append((b("Content-Range"), b("bytes */%d" % f.size)))
+            return ret
+        if ranges is not None and len(ranges) > 1:
+            return self.multipart(f, ranges, method)
+
+        ret = self.headers(f)
+        ret.append((b("Content-Type"), f.ctype))
+        if ranges is None:
+            status, start, end = 200, 0, f.size
+        else:
+            status, (start, end) = 206, ranges[0]
+            ret.append((b("Content-Range"),
+                        b("bytes %d-%d/%d" % (start, end - 1, f.size))))
+        ret.append((b("Content-Length"), b(str(end - start))))
+        if method == b("HEAD"):
+            return status, ret, []
+        return status, ret, FileBody(f, start, end - start, self.blksize)
+
+    def resolve(self, urlpath):
+        """\
+        Map a request path to a path below root, or None if it
+        isn't allowed.
+        """
+        path = unquote(urlpath)
+        if b("\0") in path:
+            return None
+        parts = []
+        for part in path.split(b("/")):
+            if part == b(".."):
+                return None
+            if part and part != b("."):
+                parts.append(part)
+        return os.path.join(self.root, *parts)
+
+    def lookup(self, path):
+        """\
+        Return the File for path or None if it isn't a regular
+        file that can be opened.
+        """
+        now = time.time()
+        f = self.files.get(path)
+        if f is not None:
+            if now - f.checked < self.ttl:
+                return f
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None and f.same(st):
+                f.checked = now
+                return f
+            self.files.pop(path)
+
+        try:
+            fd = os.open(path, OPEN_FLAGS)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES,
+                            errno.EISDIR, errno.ENAMETOOLONG, errno.ELOOP):
+                return None
+            raise
+        try:
+            st = os.fstat(fd)
+        except:
+            os.close(fd)
+            raise
+        if not stat.S_ISREG(st.st_mode):
+            os.close(fd)
+            return None
+        f = File(fd, st, self.content_type(path), now)
+        self.files.put(path, f)
+        return f
+
+    def content_type(self, path):
+        ctype, encoding = mimetypes.guess_type(path.decode("latin-1"))
+        if ctype is None or encoding is not None:
+            return DEFAULT_TYPE
+        return b(ctype)
+
+    def headers(self, f):
+        ret = [
+            (b("ETag"), f.etag),
+            (b("Last-Modified"), f.last_modified),
+            (b("Accept-Ranges"), b("bytes"))
+        ]
+        if self.cache_control is not None:
+            ret.append((b("Cache-Control"), self.cache_control))
+        return ret
+
+    def not_modified(self, f, headers):
+        inm = headers.get(b("if-none-match"))
+        if inm:
+            return etag_matches(f.etag, inm)
+        ims = headers.last(b("if-modified-since"))
+        if ims is not None:
+            ims = parse_date(ims)
+            return ims is not None and f.mtime <= ims
+        return False
+
+    def if_range(self, f, headers):
+        value = headers.last(b("if-range"))
+        if value is None:
+            return True
+        value = value.strip()
+        if value[:1] == b('"'):
+            return value == f.etag
+        if value[:2] == b("W/"):
+            return False
+        return value == f.last_modified
+
+    def multipart(self, f, ranges, method):
+        boundary = binascii.hexlify(os.urandom(16))
+        ctype = b("Content-Type: ") + f.ctype
+        parts, size = [], 0
+        for start, end in ranges:
+            head = b("\r\n").join([
+                b("\r\n--") + boundary,
+                ctype,
+                b("Content-Range: bytes %d-%d/%d" % (start, end - 1, f.size)),
+                b(""), b("")
+            ])
+            parts.append((head, start, end))
+            size += len(head) + end - start
+        tail = b("\r\n--") + boundary + b("--\r\n")
+        size += len(tail)
+
+        ret = self.headers(f)
+        ret.extend([
+            (b("Content-Type"),
+                b("multipart/byteranges; boundary=") + boundary),
+            (b("Content-Length"), b(str(size)))
+        ])
+        if method == b("HEAD"):
+            return 206, ret, []
+        return 206, ret, RangesBody(f, parts, tail, self.blksize)
+
+    def error(self, status, headers=()):
+        body = b("%d %s\n" % (status, STATUS_CODES[status]))
+        ret = list(headers)
+        ret.extend([
+            (b("Content-Type"), b("text/plain")),
+            (b("Content-Length"), b(str(len(body))))
+        ])
+        return status, ret, [body]
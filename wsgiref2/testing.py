@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -
+#
+# This file is part of wsgiref2 released under the MIT license.
+# See the NOTICE for more information.
+#
+# Helpers shared by the tests and the benchmarks for driving the
+# parser and the response writer without a network.
+
+from wsgiref2.util import b
+
+
+class FakeSocket(object):
+    """\
+    Replays data to recv_into, at most max_recv bytes at a
+    time if it's given, and keeps what is sent to it unless
+    record is False. sent is the number of bytes sent.
+    """
+    def __init__(self, data=b(""), max_recv=None, record=True):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.max_recv = max_recv
+        self.record = record
+        self.output = []
+        self.sent = 0
+
+    def recv_into(self, buf, nbytes=0):
+        size = min(len(self.data) - self.pos, nbytes or len(buf))
+        if self.max_recv:
+            size = min(size, self.max_recv)
+        buf[:size] = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def sendmsg(self, bufs):
+        size = 0
+        for data in bufs:
+            if self.record:
+                self.output.append(bytes(data))
+            size += len(data)
+        self.sent += size
+        return size
+
+    def sendall(self, data):
+        if self.record:
+            self.output.append(bytes(data))
+        self.sent += len(data)
+
+    def getvalue(self):
+        return b("").join(self.output)
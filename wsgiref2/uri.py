@@ -26,7 +26,7 @@ in an HTTP URI. Its defined as something like:
 import re
 import traceback
 
-from wsgiref2.util import b
+from wsgiref2.util import b, LRUCache
 
 class RegExNode(object):    
     def __init__(self, name=None):
@@ -160,8 +160,22 @@ patterns = [
     absolute_uri.compile()
 ]
 
-def parse(value):
-    ret = {
+# Bytes allowed by the grammar above in an abs_path and in a
+# query or fragment. Percent escapes are checked separately.
+PATH_BYTES = b("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+                "-_.!~*'():@&=+$,\";/%")
+QUERY_BYTES = PATH_BYTES + b("?<>")
+BAD_ESCAPE = re.compile(b("%(?![0-9A-Fa-f]{2})"))
+
+# Parsed targets are cached by their raw bytes. Long targets are
+# left out so that the cache's memory use stays bounded.
+CACHE_SIZE = 4096
+CACHE_MAX_KEY = 2048
+
+cache = LRUCache(CACHE_SIZE)
+
+def empty():
+    return {
         "scheme": None,
         "userinfo": None,
         "host": None,
@@ -170,6 +184,54 @@ def parse(value):
         "query": None,
         "fragment": None
     }
+
+def parse(value):
+    return dict(lookup(value))
+
+def lookup(value):
+    """\
+    Like parse but returns the cached dict itself, which must
+    not be changed. Raises ValueError for an invalid target.
+    """
+    ret = cache.get(value)
+    if ret is None:
+        ret = parse_path(value)
+        if ret is None:
+            ret = parse_regex(value)
+        if len(value) <= CACHE_MAX_KEY:
+            cache.put(value, ret)
+    return ret
+
+def parse_path(value):
+    """\
+    Split an abs_path target with an optional query and fragment
+    without going through the regular expressions. Validation is
+    a single translate() pass over each part. Returns None when
+    the target needs the full grammar, either because it isn't
+    a plain path or because it may be invalid.
+    """
+    if value[:1] != b("/"):
+        return None
+    rest, hsh, fragment = value.partition(b("#"))
+    path, qmark, query = rest.partition(b("?"))
+    if path.translate(None, PATH_BYTES):
+        return None
+    if (qmark and query.translate(None, QUERY_BYTES)) \
+            or (hsh and fragment.translate(None, QUERY_BYTES)):
+        return None
+    if b("%") in value and BAD_ESCAPE.search(value):
+        return None
+    ret = empty()
+    ret["raw"] = value
+    ret["path"] = path
+    if qmark:
+        ret["query"] = query
+    if hsh:
+        ret["fragment"] = fragment
+    return ret
+
+def parse_regex(value):
+    ret = empty()
     if value == b("*"):
         ret["path"] = b("*")
         return ret
@@ -179,4 +241,3 @@ def parse(value):
             ret.update(match.groupdict())
             return ret
     raise ValueError(b("Invalid HTTP URI: ") + value)
-
@@ -5,6 +5,9 @@
 
 # Compatibility helpers
 import sys
+import threading
+
+from collections import OrderedDict
 
 if sys.version_info < (3, 0):
     from wsgiref2.py2 import *
@@ -59,3 +62,60 @@ STATUS_CODES = {
     504: 'Gateway Timeout',
     505: 'HTTP Version Not Supported',
 }
+
+
+class LRUCache(object):
+    """\
+    A small thread safe mapping that keeps at most maxsize
+    entries, evicting the least recently used one first. With
+    a weigh function the limit applies to the sum of weigh(value)
+    over the entries instead, and values heavier than maxsize
+    are not stored at all.
+    """
+    def __init__(self, maxsize, weigh=None):
+        self.maxsize = maxsize
+        self.weigh = weigh
+        self.size = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                entry = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = entry
+            return entry[0]
+
+    def put(self, key, value):
+        weight = self.weigh and self.weigh(value) or 1
+        with self.lock:
+            self._remove(key)
+            if weight > self.maxsize:
+                return
+            self.data[key] = (value, weight)
+            self.size += weight
+            while self.size > self.maxsize:
+                self.size -= self.data.popitem(last=False)[1][1]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self._remove(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        return entry
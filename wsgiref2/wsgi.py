@@ -3,72 +3,489 @@
 # This file is part of wsgiref2 released under the MIT license. 
 # See the NOTICE for more information.
 
+import errno
+import io
+import os
+import stat
 import sys
 import traceback
 
-from wsgiref2.util import b, STATUS_CODES
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+import wsgiref2.http as http
+
+from wsgiref2.util import b, FILE_TYPES, STATUS_CODES
+
+COALESCE_SIZE = 16384
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+if IOV_MAX < 1:
+    IOV_MAX = 16
+
+# Errors meaning sendfile can't be used with this pair of
+# descriptors rather than that the transfer failed.
+SENDFILE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                            getattr(errno, "EOPNOTSUPP", errno.EINVAL))
+
+
+def is_file(fileobj):
+    """\
+    Return True if fileobj is a plain binary file reading a
+    regular file, so that sending its descriptor with sendfile
+    sends the same bytes as reading it. Pipes, sockets and
+    wrappers that decode what they read are iterated instead.
+    """
+    if type(fileobj) not in FILE_TYPES:
+        return False
+    if type(fileobj) is io.BufferedReader:
+        if type(fileobj.raw) is not io.FileIO:
+            return False
+    try:
+        return stat.S_ISREG(os.fstat(fileobj.fileno()).st_mode)
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+
+
+class Flush(object):
+    """\
+    The type of the wsgi.flush sentinel. A response body yields
+    wsgi.flush to have everything it produced so far sent to
+    the client right away instead of waiting to be coalesced.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<wsgi.flush>"
+
+FLUSH = Flush()
+
+
+class FileWrapper(object):
+    """\
+    Wraps a file object so it can be returned as a response
+    body, available to applications as wsgi.file_wrapper.
+    The server sends length bytes starting at offset with
+    os.sendfile when it can and iterates over the file in
+    blocks of blksize otherwise. An offset of None means the
+    file's current position and a length of None means up
+    to the end of the file.
+    """
+    def __init__(self, filelike, blksize=65536, offset=None, length=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.offset = offset
+        self.length = length
+        if hasattr(filelike, "close"):
+            self.close = filelike.close
+
+    def fileno(self):
+        return self.filelike.fileno()
+
+    def is_file(self):
+        return is_file(self.filelike)
+
+    def start(self):
+        """\
+        Return the offset the body starts at, or None if it
+        isn't known because the file can't tell its position.
+        """
+        if self.offset is None:
+            try:
+                self.offset = self.filelike.tell()
+            except (AttributeError, IOError, OSError):
+                return None
+        return self.offset
+
+    def __iter__(self):
+        start = self.start()
+        if start is not None:
+            self.filelike.seek(start)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.blksize
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            data = self.filelike.read(size)
+            if not data:
+                break
+            yield data
+
+
+class ResponseWriter(object):
+    """\
+    Collects the pieces of a response and sends them with as
+    few system calls as possible. Pieces are held until at
+    least threshold bytes are pending and then handed to the
+    kernel together with sendmsg, resuming after partial
+    writes. Sockets without sendmsg get one joined sendall.
+    The number of system calls made is kept in syscalls.
+    Requests that finished while their data was still pending
+    wait in waiting and get the calls of the flush that sends
+    it added to their own count.
+    """
+    def __init__(self, sock, threshold=COALESCE_SIZE):
+        self.sock = sock
+        self.threshold = threshold
+        self.pending = []
+        self.size = 0
+        self.syscalls = 0
+        self.waiting = []
+
+    def write(self, data):
+        if not len(data):
+            return
+        self.pending.append(data)
+        self.size += len(data)
+        if self.size >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending, self.size = self.pending, [], 0
+        first = self.syscalls
+        try:
+            self.send(pending)
+        finally:
+            waiting, self.waiting = self.waiting, []
+            for req in waiting:
+                req.syscalls += self.syscalls - first
+
+    def send(self, pending):
+        if not hasattr(self.sock, "sendmsg"):
+            self.syscalls += 1
+            self.sock.sendall(b("").join(pending))
+            return
+        bufs = [memoryview(data) for data in pending]
+        pos = 0
+        while pos < len(bufs):
+            sent = self.sock.sendmsg(bufs[pos:pos + IOV_MAX])
+            self.syscalls += 1
+            while pos < len(bufs) and sent >= len(bufs[pos]):
+                sent -= len(bufs[pos])
+                pos += 1
+            if sent:
+                bufs[pos] = bufs[pos][sent:]
+
+    def sendfile(self, fileobj, offset=0, count=None):
+        """\
+        Send count bytes of fileobj starting at offset straight
+        from the page cache. Returns False without sending
+        anything if the socket or file can't be used with
+        os.sendfile so the caller can fall back to reading.
+        """
+        if not hasattr(os, "sendfile"):
+            return False
+        if ssl is not None and isinstance(self.sock, ssl.SSLSocket):
+            return False
+        try:
+            sockfd = self.sock.fileno()
+            filefd = fileobj.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        if count is None:
+            count = max(os.fstat(filefd).st_size - offset, 0)
+        self.flush()
+        sent_any = False
+        while count > 0:
+            try:
+                sent = os.sendfile(sockfd, filefd, offset, min(count, 1 << 30))
+            except OSError as e:
+                if not sent_any and e.errno in SENDFILE_UNSUPPORTED:
+                    return False
+                raise
+            self.syscalls += 1
+            if not sent:
+                raise IOError("File ended before the response was sent.")
+            sent_any = True
+            offset += sent
+            count -= sent
+        return True
+
+
+def server_name(env):
+    host = env.headers.last(b("host"))
+    if host is None:
+        return b(env.server_address[0])
+    return host.split(b(":"), 1)[0]
+
+def server_port(env):
+    host = env.headers.last(b("host"))
+    if host is not None:
+        parts = host.split(b(":"), 1)
+        if len(parts) > 1 and parts[1].isdigit():
+            return int(parts[1])
+    return env.server_address[1]
+
+# Environ entries that are only computed when first read. The Host
+# header only describes this request so it must never leak into the
+# server's address, which is shared between every request and thread.
+LAZY = {
+    "wsgi.upgraded": lambda env: env.is_upgraded,
+    "conn.server_name": server_name,
+    "conn.server_port": server_port,
+    "http.uri.path": lambda env: env.target["path"] or None,
+    "http.uri.query_string": lambda env: env.target["query"] or None,
+    "http.trailers": lambda env: {}
+}
+
+
+class Environ(dict):
+    """\
+    The environ given to applications. It is a real dict but
+    the entries in LAZY are only computed the first time they
+    are read, after which they are stored like any other key.
+    Methods that look at every entry compute the missing ones
+    first so applications can't tell the difference.
+
+    The request objects are reset for the next request on the
+    connection, so the lazy entries are computed from the
+    parts of the request captured here, which are never
+    changed once parsed.
+    """
+    __slots__ = ("request", "server_address", "headers", "target",
+                    "deleted")
+
+    def __init__(self, request, values):
+        super(Environ, self).__init__(values)
+        self.request = request
+        self.server_address = request.server_address
+        self.headers = request.httpreq.headers
+        self.target = request.httpreq.target
+        self.deleted = None
+
+    def is_upgraded(self):
+        # The request only belongs to this environ until it's reset.
+        return self.request.environ is self and self.request.upgraded
+
+    def __missing__(self, key):
+        if not self.pending(key):
+            raise KeyError(key)
+        value = LAZY[key](self)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def pending(self, key):
+        if key not in LAZY or dict.__contains__(self, key):
+            return False
+        return self.deleted is None or key not in self.deleted
+
+    def load(self):
+        for key in LAZY:
+            if self.pending(key):
+                self[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self.pending(key)
+
+    def __delitem__(self, key):
+        pending = self.pending(key)
+        if key in LAZY:
+            if self.deleted is None:
+                self.deleted = set()
+            self.deleted.add(key)
+        if not pending:
+            dict.__delitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def copy(self):
+        self.load()
+        return dict(self)
+
+    def __reduce__(self):
+        self.load()
+        return (dict, (dict(self),))
+
+
+def _loading(name):
+    method = getattr(dict, name)
+    def wrapper(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ("__iter__", "__len__", "__eq__", "__ne__", "__repr__",
+                "keys", "values", "items", "popitem", "iterkeys",
+                "itervalues", "iteritems"):
+    if hasattr(dict, _name):
+        setattr(Environ, _name, _loading(_name))
+
+
+class ChunkedWriter(object):
+    """\
+    Frames a response body with chunked transfer encoding on
+    top of a ResponseWriter. Small writes are held back and
+    sent as a single chunk once threshold bytes are pending or
+    when a flush is asked for. The pieces are passed on as they
+    are so the data is never copied to build a chunk.
+    """
+    __slots__ = ("writer", "threshold", "pending", "size")
+
+    def __init__(self, writer, threshold=COALESCE_SIZE):
+        self.writer = writer
+        self.threshold = threshold
+        self.pending = []
+        self.size = 0
+
+    def write(self, data):
+        if not len(data):
+            return
+        self.pending.append(data)
+        self.size += len(data)
+        if self.size >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        self.writer.write(b("%x\r\n" % self.size))
+        self.size = 0
+        for data in pending:
+            self.writer.write(data)
+        self.writer.write(b("\r\n"))
+
+    def close(self, trailers=None):
+        self.flush()
+        last = [b("0")]
+        for name, value in trailers or ():
+            last.append(name + b(": ") + value)
+        last.extend([b(""), b("")])
+        self.writer.write(b("\r\n").join(last))
+
 
 class Request(object):
-    def __init__(self, server_address, client_address, socket, httpreq):
+    """\
+    Builds the environ for one HTTP request, calls the
+    application and writes its response. Writes go through a
+    ResponseWriter so that the status line, headers and first
+    chunks of the body leave in one system call. The number
+    of calls a response cost is available as syscalls once
+    it has been sent, counting a call shared with pipelined
+    responses for each of them.
+
+    A writer shared by the requests on a connection can be
+    passed in. Its owner then decides when to flush it, which
+    lets pipelined responses leave together.
+
+    Responses to HTTP/1.1 clients that set neither Content-Length
+    nor Transfer-Encoding are sent with chunked encoding, ending
+    with any trailers found in the body's trailers attribute.
+    HTTP/1.0 clients get such responses followed by the
+    connection being closed. The next request
+    on a connection can be set up in the same object with
+    reset() once the previous one has been answered.
+    """
+    __slots__ = ("server_address", "client_address", "socket", "httpreq",
+                    "autoflush", "writer", "chunked", "closing",
+                    "started", "upgraded",
+                    "first_syscall", "syscalls", "environ")
+
+    def __init__(self, server_address, client_address, socket, httpreq,
+                    multithread=False, multiprocess=False,
+                    coalesce_size=COALESCE_SIZE, writer=None):
+        self.reset(server_address, client_address, socket, httpreq,
+                    multithread, multiprocess, coalesce_size, writer)
+
+    def reset(self, server_address, client_address, socket, httpreq,
+                    multithread=False, multiprocess=False,
+                    coalesce_size=COALESCE_SIZE, writer=None):
         self.server_address = server_address
         self.client_address = client_address
         self.socket = socket
         self.httpreq = httpreq
+        self.autoflush = writer is None
+        if writer is None:
+            writer = ResponseWriter(socket, coalesce_size)
+        elif self in writer.waiting:
+            # Reused before the last response was flushed.
+            writer.waiting.remove(self)
+        self.writer = writer
+        self.chunked = None
+        self.closing = False
         self.started = False
         self.upgraded = False
+        self.first_syscall = 0
+        self.syscalls = 0
 
         url_scheme = "http"
         script_name = ""
 
-        for name, value in httpreq.headers:
-            name = name.strip().lower()
-            value = value.strip()
-            if name == "host":
-                parts = value.split(":", 1)
-                server_address[0] = parts[0]
-                if len(parts) > 1:
-                    server_address[1] = int(parts[1])
-            elif name == "x-forwarded-protocol" and value.lower() == "ssl":
+        headers = httpreq.headers
+        for value in headers.get(b("x-forwarded-protocol"), ()):
+            if value.lower() == b("ssl"):
                 url_scheme = "https"
-            elif name == "x-forwarded-ssl" and value.lower() == "on":
+        for value in headers.get(b("x-forwarded-ssl"), ()):
+            if value.lower() == b("on"):
                 url_scheme = "https"
-            elif name == "x-script-name":
-                script_name = value
-            elif name == "expect" and value.lower() == "100-continue":
+        script_name = headers.last(b("x-script-name"), script_name)
+        for value in headers.get(b("expect"), ()):
+            if value.lower() == b("100-continue"):
                 httpreq.body.set_pre_read(self.pre_read)
-            elif name == "transfer-encoding" and value.lower() == "chunked":
-                self.body.set_trailer_handler(self.handle_trailers)
+        te = headers.last(b("transfer-encoding"))
+        if te is not None and te.lower() == b("chunked"):
+            httpreq.body.set_trailers_handler(self.handle_trailers)
 
-        self.environ = {
+        self.environ = Environ(self, {
             "wsgi.version": (2, 0),
             "wsgi.uri_scheme": url_scheme,
             "wsgi.path": "",
-            "wsgi.multithread": False,
-            "wsgi.multiprocess": False,
+            "wsgi.multithread": multithread,
+            "wsgi.multiprocess": multiprocess,
             "wsgi.upgrade": self.upgrade,
-            "wsgi.upgraded": lambda: self.upgraded,
             "wsgi.errors": sys.stderr,
+            "wsgi.file_wrapper": FileWrapper,
+            "wsgi.flush": FLUSH,
 
-            "conn.server_name": server_address[0],
-            "conn.server_port": server_address[1],
             "conn.remote_addr": client_address[0],
             "conn.remote_port": client_address[1],
 
-            "http.method": httpreq.method
+            "http.method": httpreq.method,
             "http.uri.raw": httpreq.uri,
-            "http.uri.path": httpreq.path,
-            "http.uri.query_string": httpreq.query_string
             "http.version": httpreq.version,
-            "http.headers": {},
-            "http.trailers": {},
+            "http.headers": headers,
             "http.body": httpreq.body
-        }
-        
-        for (name, value) in httpreq.headers:
-            name, value = name.strip.lower(), value.strip()
-            self.environ["http.headers"].setdefault(name, []).append(value)
+        })
 
     def handle(self, app):
+        """\
+        Call app with the environ and send its response. Returns
+        False if the application upgraded the connection.
+
+        The application returns a (status, headers, body) tuple
+        where body is an iterable of bytes. Event loop backends
+        such as wsgiref2.aio also accept coroutine applications,
+        whose result is awaited, and bodies that are asynchronous
+        iterators. Those are driven by the backend on top of
+        write_head() and write(); this method only calls
+        synchronous applications.
+        """
         try:
             response = app(self.environ)
             if response is None:
@@ -78,36 +495,123 @@ class Request(object):
         except:
             if self.started:
                 raise
-            tb = traceback.format_exc().encode("ascii", "replace")
+            self.respond(*self.error_response())
+        return True
+
+    def error_response(self):
+        if isinstance(sys.exc_info()[1], http.BodyTooLarge):
+            # The rest of the body isn't worth reading.
+            self.closing = True
+            body = b("Request body too large.\n")
             headers = [
                 (b("Content-Type"), b("text/plain")),
-                (b("Content-Length"), b(str(len(tb))))
+                (b("Content-Length"), b(str(len(body))))
             ]
-            self.respond(500, headers, [tb])
-        return True
+            return 413, headers, [body]
+        tb = traceback.format_exc().encode("ascii", "replace")
+        headers = [
+            (b("Content-Type"), b("text/plain")),
+            (b("Content-Length"), b(str(len(tb))))
+        ]
+        return 500, headers, [tb]
 
     def respond(self, status, headers, body):
+        try:
+            self.write_head(status, headers)
+            if self.has_body(status) and (self.chunked is not None
+                    or not self.sendfile(body)):
+                for data in body:
+                    self.write(data)
+            self.finish(getattr(body, "trailers", None))
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    def sendfile(self, body):
+        if isinstance(body, FileWrapper):
+            if not body.is_file():
+                return False
+            offset = body.start()
+            if offset is None:
+                return False
+            return self.writer.sendfile(body, offset, body.length)
+        if not is_file(body):
+            return False
+        try:
+            offset = body.tell()
+        except (AttributeError, IOError, OSError):
+            offset = 0
+        return self.writer.sendfile(body, offset)
+
+    def write_head(self, status, headers):
         front = [b("HTTP/1.1 %d %s" % (status, STATUS_CODES[status]))]
+        framed = False
         for name, value in headers:
+            lname = name.lower()
+            if lname == b("content-length") or lname == b("transfer-encoding"):
+                framed = True
             front.append(name + b(": ") + value)
+        if not framed and self.has_body(status):
+            if self.httpreq.version >= (1, 1):
+                front.append(b("Transfer-Encoding: chunked"))
+                self.chunked = ChunkedWriter(self.writer, self.writer.threshold)
+            else:
+                front.append(b("Connection: close"))
+                self.closing = True
         front.extend([b(""), b("")])
         self.started = True
-        self.socket.send(b("\r\n").join(front))
-        for data in body:
-            self.socket.send(data)
+        self.first_syscall = self.writer.syscalls
+        self.writer.write(b("\r\n").join(front))
+
+    def has_body(self, status):
+        # Any body an application returns for these isn't sent.
+        if self.httpreq.method == b("HEAD"):
+            return False
+        return status >= 200 and status not in (204, 304)
+
+    def write(self, data):
+        if data is FLUSH:
+            self.flush()
+        elif self.chunked is not None:
+            self.chunked.write(data)
+        else:
+            self.writer.write(data)
+
+    def flush(self):
+        if self.chunked is not None:
+            self.chunked.flush()
+        self.writer.flush()
+
+    def finish(self, trailers=None):
+        if self.chunked is not None:
+            self.chunked.close(trailers)
+            self.chunked = None
+        if self.autoflush:
+            self.writer.flush()
+        self.syscalls = self.writer.syscalls - self.first_syscall
+        if self.writer.pending:
+            # The rest is counted when the connection flushes it.
+            self.writer.waiting.append(self)
 
     def pre_read(self):
-        self.socket.send("HTTP/1.1 100 Continue\r\n\r\n")
+        self.writer.write(b("HTTP/1.1 100 Continue\r\n\r\n"))
+        self.writer.flush()
 
     def handle_trailers(self, trailers):
-        for name, value in trailers:
-            name, value = name.strip().lower(), value.strip()
-            self.environ["http.trailers"].setdefault(name, []).append(value)
+        for name, values in trailers.items():
+            self.environ["http.trailers"].setdefault(name, []).extend(values)
+
+    def should_close(self):
+        return self.closing or self.httpreq.should_close()
+
+    def is_upgraded(self):
+        return self.upgraded
 
     def upgrade(self):
         if self.started:
             raise RuntimeError("Already upgraded.")
         self.started = True
         self.upgraded = True
+        self.writer.flush()
         return self.socket
 